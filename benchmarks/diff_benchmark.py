@@ -0,0 +1,61 @@
+"""
+@File  : diff_benchmark.py
+@Author: lyj
+@Create  : 2024/7/8 11:03
+@Modify  :
+@Description  : 差异比较耗时测试，文件数量从 1k 到 1M
+
+运行: python benchmarks/diff_benchmark.py [最大文件数]
+"""
+import hashlib
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from file_diff import diff_files  # noqa: E402
+
+SIZES = (1_000, 10_000, 100_000, 1_000_000)
+
+
+def make_listings(count, seed=0):
+    """
+    构造一对本地/远程文件列表：约 1% 内容不一致，0.5% 只在本地，0.5% 只在远程
+    """
+    rnd = random.Random(seed)
+    local_files = []
+    remote_files = []
+    for i in range(count):
+        relative_path = f'app/module_{i % 97}/sub_{i % 13}/file_{i}.py'
+        md5 = hashlib.md5(relative_path.encode()).hexdigest()
+        roll = rnd.random()
+        if roll < 0.005:
+            local_files.append(('/local/' + relative_path, relative_path, md5))
+        elif roll < 0.01:
+            remote_files.append(('/remote/' + relative_path, relative_path, md5))
+        else:
+            remote_md5 = md5[::-1] if roll < 0.02 else md5
+            local_files.append(('/local/' + relative_path, relative_path, md5))
+            remote_files.append(('/remote/' + relative_path, relative_path, remote_md5))
+    rnd.shuffle(local_files)
+    rnd.shuffle(remote_files)
+    return local_files, remote_files
+
+
+def main():
+    max_count = int(sys.argv[1]) if len(sys.argv) > 1 else SIZES[-1]
+    print(f'{"文件数":>10} {"差异数":>8} {"耗时(s)":>10} {"每文件(us)":>12}')
+    for count in SIZES:
+        if count > max_count:
+            break
+        local_files, remote_files = make_listings(count)
+        start = time.perf_counter()
+        changes = sum(1 for _ in diff_files(local_files, remote_files))
+        elapsed = time.perf_counter() - start
+        print(f'{count:>10} {changes:>8} {elapsed:>10.3f} {elapsed / count * 1e6:>12.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""
+@File  : manifest_benchmark.py
+@Author: lyj
+@Create  : 2024/8/2 15:40
+@Modify  :
+@Description  : 刷新比较的内存峰值测试，比较部分文件数量从 100k 到 1M，本地扫描部分从 10k 到 100k
+
+运行: python benchmarks/manifest_benchmark.py [最大文件数] [内存中等待配对的文件数上限]
+
+最坏情况：远程文件全部先到达，本地文件再逐个到达（本地计算哈希比远程慢很多时就是这样）。
+比较三种方式的内存峰值（tracemalloc 统计，不包括临时文件）:
+    列表      两侧文件列表全部放在内存中，排序后归并比较（diff_files）
+    增量      IncrementalDiff 不限制等待配对的文件数，先到达的一侧全部留在内存中
+    有序段    IncrementalDiff 超过上限后写入 SortedManifest 的临时文件，扫描结束后归并比较
+
+参考结果（相对路径约 35 字节，md5 哈希值，上限 100000，开启 tracemalloc 时的耗时）:
+       文件数     方式      差异数     峰值(MB)      耗时(s)
+    100000     列表     2000       69.2       3.32
+    100000     增量     2000       36.0       3.32
+    100000    有序段     2000       36.0       3.67
+   1000000     列表    20000      696.5      46.60
+   1000000     增量    20000      354.8      44.12
+   1000000    有序段    20000       48.0      80.80
+有序段方式的峰值由上限决定（10 万个等待配对的文件约 36MB），和文件总数无关；
+临时文件每个文件约 71 字节（22 字节记录头 + 相对路径 + 16 字节二进制哈希值）。
+
+本地扫描部分在临时目录中生成小文件，比较 get_all_files 几种方式的内存峰值（不包括SQLite的页缓存）:
+    保留列表  keep=True，不使用哈希缓存，返回全部文件列表（多服务器共用本地文件、监听模式）
+    逐个交出  keep=False，不使用哈希缓存，文件计算完哈希交给 on_file 后不再保存（刷新时），
+              正在计算的文件不超过线程数的 4 倍
+    冷缓存    keep=False，哈希缓存为空，计算的哈希值按批写入缓存
+    热缓存    keep=False，哈希缓存命中全部文件，每个文件夹的文件一起查找缓存
+
+参考结果（8 个线程）:
+       文件数     方式     峰值(MB)      耗时(s)
+     10000   保留列表        7.6       2.82
+     10000   逐个交出        4.4       2.45
+     10000    冷缓存        5.2       3.74
+     10000    热缓存        1.2       0.66
+    100000   保留列表       36.9      30.67
+    100000   逐个交出        6.4      21.00
+    100000    冷缓存        6.2      20.96
+    100000    热缓存        1.3       7.56
+逐个交出的峰值主要是每个线程 1MB 的读缓冲，使用缓存时不把缓存读入内存，峰值都和文件数基本无关。
+刷新时其余和文件数成正比的内存：开启 detect_moves 时按哈希值记录的远程文件、只有一侧存在的文件，
+以及快速比较模式下需要再比较哈希值的文件，这几部分不写入临时文件。
+"""
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from file_diff import FileEntry, IncrementalDiff, diff_files  # noqa: E402
+from file_manifest import DEFAULT_RUN_SIZE, SortedManifest  # noqa: E402
+from file_comparator import FolderComparator  # noqa: E402
+from hash_algorithms import get_algorithm  # noqa: E402
+
+SIZES = (100_000, 1_000_000)
+SCAN_SIZES = (10_000, 100_000)
+SCAN_WORKERS = 8
+
+
+def make_entries(count, side):
+    """
+    按下标生成一侧的文件：约 1% 内容不一致，0.5% 只在本地，0.5% 只在远程
+    """
+    for i in range(count):
+        relative_path = f'app/module_{i % 97}/sub_{i % 13}/file_{i}.py'
+        md5 = hashlib.md5(relative_path.encode()).hexdigest()
+        roll = i * 7919 % 1000
+        if side == 'local' and 5 <= roll < 10:
+            continue
+        if side == 'remote' and roll < 5:
+            continue
+        if side == 'remote' and 10 <= roll < 20:
+            md5 = md5[::-1]
+        root = '/local/' if side == 'local' else '/remote/'
+        yield FileEntry(root + relative_path, relative_path, md5)
+
+
+def run_list(count, _):
+    local_files = list(make_entries(count, 'local'))
+    remote_files = list(make_entries(count, 'remote'))
+    return sum(1 for _ in diff_files(local_files, remote_files))
+
+
+def run_incremental(count, max_pending):
+    spill = None
+    if max_pending:
+        def spill(side):
+            return SortedManifest('/local' if side == 'local' else '/remote', run_size=max_pending)
+    diff = IncrementalDiff(max_pending=max_pending, spill=spill)
+    changes = 0
+    try:
+        for entry in make_entries(count, 'remote'):
+            changes += diff.add_remote(entry) is not None
+        diff.close_remote()
+        for entry in make_entries(count, 'local'):
+            changes += diff.add_local(entry) is not None
+        diff.close_local()
+        changes += sum(1 for _ in diff.finish())
+    finally:
+        diff.close()
+    return changes
+
+
+def make_folder(count, folder):
+    """
+    在 folder 中生成 count 个小文件，每个子目录 1000 个。
+    修改时间设为一小时前，否则刚修改的文件不写入哈希缓存
+    """
+    mtime = time.time() - 3600
+    for i in range(count):
+        directory = os.path.join(folder, f'module_{i // 1000}')
+        if i % 1000 == 0:
+            os.makedirs(directory)
+        path = os.path.join(directory, f'file_{i}.py')
+        with open(path, 'w') as f:
+            f.write(f'print({i})\n')
+        os.utime(path, (mtime, mtime))
+
+
+def run_scan(folder, options):
+    keep, hash_cache, force_rehash = options
+    comparator = FolderComparator('benchmark', 'refresh', [], [], None, None, None, None,
+                                  local_folder=folder, remote_folder='/remote', hash_cache=hash_cache,
+                                  force_rehash=force_rehash, hash_workers=SCAN_WORKERS,
+                                  hash_algorithm='md5', on_log=lambda message: None)
+    comparator.algorithm = get_algorithm('md5')
+    count = 0
+
+    def on_file(_):
+        nonlocal count
+        count += 1
+
+    comparator.get_all_files(folder, on_file, keep=keep)
+    return count
+
+
+def measure(function, count, max_pending):
+    tracemalloc.start()
+    start = time.perf_counter()
+    changes = function(count, max_pending)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return changes, peak, elapsed
+
+
+def main():
+    max_count = int(sys.argv[1]) if len(sys.argv) > 1 else SIZES[-1]
+    max_pending = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_RUN_SIZE
+    methods = (('列表', run_list, None), ('增量', run_incremental, None), ('有序段', run_incremental, max_pending))
+    print(f'{"文件数":>10} {"方式":>6} {"差异数":>8} {"峰值(MB)":>10} {"耗时(s)":>10}')
+    for count in SIZES:
+        if count > max_count:
+            break
+        results = set()
+        for name, function, limit in methods:
+            changes, peak, elapsed = measure(function, count, limit)
+            results.add(changes)
+            print(f'{count:>10} {name:>6} {changes:>8} {peak / 1024 / 1024:>10.1f} {elapsed:>10.2f}')
+        assert len(results) == 1, '三种方式的差异数不一致'
+
+    # (名称, (keep, hash_cache, force_rehash))
+    scans = (('保留列表', (True, False, False)), ('逐个交出', (False, False, False)),
+             ('冷缓存', (False, True, True)), ('热缓存', (False, True, False)))
+    print(f'{"文件数":>10} {"方式":>6} {"峰值(MB)":>10} {"耗时(s)":>10}')
+    cwd = os.getcwd()
+    for count in SCAN_SIZES:
+        if count > max_count:
+            break
+        # 哈希缓存保存在当前目录下，放在临时目录中，不在扫描的文件夹里
+        work = tempfile.mkdtemp(prefix='filesync-bench-')
+        folder = os.path.join(work, 'files')
+        make_folder(count, folder)
+        os.chdir(work)
+        try:
+            for name, options in scans:
+                files, peak, elapsed = measure(run_scan, folder, options)
+                assert files == count, '扫描到的文件数不一致'
+                print(f'{count:>10} {name:>6} {peak / 1024 / 1024:>10.1f} {elapsed:>10.2f}')
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(work)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+"""
+@File  : delta_transfer.py
+@Author: lyj
+@Create  : 2024/7/15 10:05
+@Modify  :
+@Description  : rsync 方式的增量传输
+
+远程文件按固定大小分块，远程辅助脚本计算每块的弱校验值(滚动校验)和MD5，
+本地用滚动校验在任意偏移位置查找相同的块，只发送找不到的数据。
+远程辅助脚本根据旧文件和收到的指令生成新文件，校验整个文件的MD5后原子替换。
+"""
+import hashlib
+import math
+import shlex
+import struct
+from itertools import accumulate
+
+# 分块大小的范围，实际大小约为文件大小的平方根
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 128 * 1024
+# 单条数据指令的最大长度
+MAX_LITERAL_CHUNK = 1024 * 1024
+
+_MOD = 1 << 16
+_COPY = struct.Struct('>cQI')
+_DATA = struct.Struct('>cI')
+_END = b'E'
+
+# 远程计算块签名，每块输出一行 "<弱校验值> <MD5>"，最后不足一块的部分不输出
+SIGNATURE_SCRIPT = r'''
+import hashlib, sys
+from itertools import accumulate
+path, block_size = sys.argv[1], int(sys.argv[2])
+out = sys.stdout
+with open(path, 'rb') as f:
+    while True:
+        block = f.read(block_size)
+        if len(block) < block_size:
+            break
+        a = sum(block) % 65536
+        b = sum(accumulate(block)) % 65536
+        out.write('%08x %s\n' % (a | (b << 16), hashlib.md5(block).hexdigest()))
+'''
+
+# 远程根据旧文件和标准输入中的指令生成新文件，MD5一致后原子替换旧文件，可选设置新文件的修改时间
+PATCH_SCRIPT = r'''
+import hashlib, os, struct, sys, tempfile
+path, block_size, expected = sys.argv[1], int(sys.argv[2]), sys.argv[3]
+mtime = float(sys.argv[4]) if len(sys.argv) > 4 else None
+source = sys.stdin.buffer
+
+def read_exact(size):
+    data = source.read(size)
+    if len(data) != size:
+        raise EOFError('unexpected end of delta stream')
+    return data
+
+fd, tmp = tempfile.mkstemp(prefix='.filesync-', dir=os.path.dirname(path) or '.')
+md5 = hashlib.md5()
+try:
+    with open(path, 'rb') as old, os.fdopen(fd, 'wb') as new:
+        while True:
+            op = read_exact(1)
+            if op == b'C':
+                index, count = struct.unpack('>QI', read_exact(12))
+                old.seek(index * block_size)
+                remaining = count * block_size
+                while remaining:
+                    chunk = old.read(min(remaining, 1048576))
+                    if not chunk:
+                        raise EOFError('basis file changed')
+                    new.write(chunk)
+                    md5.update(chunk)
+                    remaining -= len(chunk)
+            elif op == b'D':
+                size, = struct.unpack('>I', read_exact(4))
+                chunk = read_exact(size)
+                new.write(chunk)
+                md5.update(chunk)
+            elif op == b'E':
+                break
+            else:
+                raise ValueError('bad delta op %r' % op)
+    if md5.hexdigest() != expected:
+        raise ValueError('checksum mismatch')
+    os.chmod(tmp, os.stat(path).st_mode & 0o7777)
+    if mtime is not None:
+        os.utime(tmp, (mtime, mtime))
+    os.rename(tmp, path)
+except BaseException:
+    os.unlink(tmp)
+    raise
+sys.stdout.write('ok\n')
+'''
+
+
+class DeltaTooLarge(Exception):
+    """
+    需要发送的数据太多，增量传输不划算
+    """
+
+
+def choose_block_size(size):
+    """
+    根据文件大小选择分块大小
+    """
+    block_size = math.isqrt(size) // 1024 * 1024
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block_size))
+
+
+def signature_command(remote_path, block_size):
+    """
+    获取远程文件块签名的命令
+    """
+    return f'python3 -c {shlex.quote(SIGNATURE_SCRIPT)} {shlex.quote(remote_path)} {int(block_size)}'
+
+
+def patch_command(remote_path, block_size, expected_md5, mtime=None):
+    """
+    远程合并增量数据的命令，mtime 不为空时新文件使用这个修改时间
+    """
+    command = (f'python3 -c {shlex.quote(PATCH_SCRIPT)} {shlex.quote(remote_path)} {int(block_size)} '
+               f'{shlex.quote(expected_md5)}')
+    if mtime is not None:
+        command += f' {mtime!r}'
+    return command
+
+
+def parse_signatures(output):
+    """
+    解析远程块签名
+
+    :param output: 签名命令的输出
+    :return: {弱校验值: [(块序号, MD5), ...]}
+    """
+    signatures = {}
+    for index, line in enumerate(output.splitlines()):
+        weak, strong = line.split()
+        signatures.setdefault(int(weak, 16), []).append((index, strong))
+    return signatures
+
+
+def weak_checksum(block):
+    """
+    计算数据块的弱校验值，返回 (a, b)，校验值为 a | (b << 16)
+    """
+    return sum(block) % _MOD, sum(accumulate(block)) % _MOD
+
+
+class DeltaEncoder:
+    """
+    根据远程块签名，把本地文件编码为增量指令流。
+
+    指令格式:
+        C <块序号 Q> <连续块数 I>   复制远程旧文件中的块
+        D <长度 I> <数据>           新的数据
+        E                           结束
+    """
+
+    def __init__(self, signatures, block_size, max_literal):
+        """
+        :param signatures: parse_signatures 的结果
+        :param block_size: 分块大小
+        :param max_literal: 需要发送的数据超过这个字节数时抛出 DeltaTooLarge
+        """
+        self.signatures = signatures
+        self.block_size = block_size
+        self.max_literal = max_literal
+        self.literal_bytes = 0
+        self.copied_bytes = 0
+
+    def encode(self, data):
+        """
+        :param data: 本地文件内容，bytes 或 mmap
+        :return: 生成器，产出编码后的指令
+        """
+        block_size = self.block_size
+        signatures = self.signatures
+        length = len(data)
+        copy_index = copy_count = 0
+        literal_start = pos = 0
+        weak = None
+
+        while pos + block_size <= length:
+            if weak is None:
+                a, b = weak_checksum(data[pos:pos + block_size])
+                weak = a | (b << 16)
+
+            candidates = signatures.get(weak)
+            if candidates:
+                strong = hashlib.md5(data[pos:pos + block_size]).hexdigest()
+                index = next((index for index, digest in candidates if digest == strong), None)
+                if index is not None:
+                    if literal_start < pos:
+                        if copy_count:
+                            yield _COPY.pack(b'C', copy_index, copy_count)
+                            copy_count = 0
+                        yield from self._literal(data, literal_start, pos)
+                    if copy_count and index == copy_index + copy_count:
+                        copy_count += 1
+                    else:
+                        if copy_count:
+                            yield _COPY.pack(b'C', copy_index, copy_count)
+                        copy_index, copy_count = index, 1
+                    self.copied_bytes += block_size
+                    pos += block_size
+                    literal_start = pos
+                    weak = None
+                    continue
+
+            # 没有匹配的块，窗口向后滚动一个字节
+            if pos + block_size >= length:
+                break
+            old_byte = data[pos]
+            new_byte = data[pos + block_size]
+            a = (a - old_byte + new_byte) % _MOD
+            b = (b - block_size * old_byte + a) % _MOD
+            weak = a | (b << 16)
+            pos += 1
+            if pos - literal_start > self.max_literal - self.literal_bytes:
+                raise DeltaTooLarge()
+
+        if copy_count:
+            yield _COPY.pack(b'C', copy_index, copy_count)
+        if literal_start < length:
+            yield from self._literal(data, literal_start, length)
+        yield _END
+
+    def _literal(self, data, start, end):
+        self.literal_bytes += end - start
+        if self.literal_bytes > self.max_literal:
+            raise DeltaTooLarge()
+        for offset in range(start, end, MAX_LITERAL_CHUNK):
+            chunk = data[offset:min(end, offset + MAX_LITERAL_CHUNK)]
+            yield _DATA.pack(b'D', len(chunk)) + chunk
@@ -0,0 +1,1688 @@
+"""
+@File  : file_comparator.py
+@Author: lyj
+@Create  : 2024/6/26 15:23
+@Modify  : 2024/7/23 09:40
+@Description  : 文件比较和同步，不依赖 PyQt，界面线程和命令行共用
+
+日志和结果通过回调函数输出，paramiko 在第一次连接服务器时才导入。
+"""
+import gzip
+import hashlib
+import mmap
+import os
+import posixpath
+import queue
+import shlex
+import stat
+import tarfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+
+from delta_transfer import DeltaEncoder, DeltaTooLarge, choose_block_size, parse_signatures, patch_command, \
+    signature_command
+from file_diff import FileEntry, IncrementalDiff, detect_moves, quick_compare
+from file_manifest import DEFAULT_RUN_SIZE, SortedManifest
+from hash_algorithms import AUTO, DEFAULT_ALGORITHM, choose_algorithm, get_algorithm, probe_command
+from hash_cache import HashCache, get_cache_path
+from ignore_rules import IgnoreRules
+from remote_listing import STAT_ACTION, build_checksum_command, build_find_command, parse_checksum_line, \
+    parse_stat_record, upload_temp_path
+from remote_manifest import MANIFEST_STAT_ACTION, list_command as manifest_list_command, \
+    update_command as manifest_update_command
+from ssh_pool import DEFAULT_KEEPALIVE, connection_pool
+
+# 计算哈希时每次读取的字节数
+HASH_CHUNK_SIZE = 1024 * 1024
+# 超过这个大小的文件使用 mmap 一次性计算哈希
+HASH_MMAP_THRESHOLD = 64 * 1024 * 1024
+# 读取远程命令输出时每次接收的字节数
+STREAM_CHUNK_SIZE = 64 * 1024
+# tar方式上传时的写缓冲大小
+TAR_BUFFER_SIZE = 1024 * 1024
+# 增量上传时需要发送的数据超过文件大小的这个比例就改为完整上传
+DELTA_MAX_LITERAL_RATIO = 0.5
+# 计算本地文件哈希时，每个线程最多排队的文件数，限制遍历领先计算的文件数
+HASH_QUEUE_PER_WORKER = 4
+# 本地文件哈希进度日志的最小间隔（秒）
+PROGRESS_INTERVAL = 1.0
+# 不小于这个字节数的文件先上传到临时文件，支持断点续传，完成后原子替换目标文件
+DEFAULT_RESUME_THRESHOLD = 8 * 1024 * 1024
+# 上传大文件时每次读取本地文件的字节数，也是SFTP文件的写缓冲大小
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# 分段并行上传时每段的最小字节数
+UPLOAD_MIN_PART_SIZE = 32 * 1024 * 1024
+# 分段上传续传时，按这个大小分块比较临时文件中已上传的数据
+RESUME_BLOCK_SIZE = 8 * 1024 * 1024
+# 大文件上传中断后，连接仍然可用时从断点重试的次数
+UPLOAD_RETRIES = 2
+
+# 批量删除文件，输出删除失败的文件，以NUL分隔
+BULK_REMOVE_COMMAND = 'xargs -0 -r sh -c \'for f; do rm -- "$f" 2>/dev/null || printf "%s\\0" "$f"; done\' sh'
+# 批量删除空目录，不为空的目录跳过，输出删除成功的目录，以NUL分隔
+PRUNE_DIRS_COMMAND = 'xargs -0 -r sh -c \'for d; do rmdir -- "$d" 2>/dev/null && printf "%s\\0" "$d"; done; true\' sh'
+# 远程复制/移动文件的命令，(来源, 目标) 成对出现，不能用 xargs 分批，改为生成一个 sh 脚本从标准输入执行
+REMOTE_COPY_COMMANDS = {'copy': 'cp -p --', 'move': 'mv -f --'}
+
+
+class ScanCancelled(Exception):
+    """
+    刷新被取消
+    """
+
+
+def local_range_md5(local_file, start, end):
+    """
+    本地文件 [start, end) 范围内数据的md5，文件不够长时返回 None
+    """
+    local_md5 = hashlib.md5()
+    with open(local_file, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(HASH_CHUNK_SIZE, remaining))
+            if not chunk:
+                return None
+            local_md5.update(chunk)
+            remaining -= len(chunk)
+    return local_md5.hexdigest()
+
+
+def comparator_options(server):
+    """
+    把 config.yaml 中一个服务器的配置转换为 FolderComparatorThread 的参数
+
+    :param server: 服务器配置
+    :return: 参数字典，不包括 server_name/flag/changed_files
+    """
+    return dict(
+        hostname=server.get("hostname"),
+        port=server.get("port"),
+        username=server.get("username"),
+        password=server.get("password"),
+        key_file_path=server.get("key_file_path"),
+        local_folder=server.get("local_folder"),
+        remote_folder=server.get("remote_folder"),
+        ignore_folders=server.get("ignore_folders"),
+        ignore_file_types=server.get("ignore_file_types"),
+        hash_cache=server.get("hash_cache", True),
+        hash_workers=server.get("hash_workers"),
+        remote_hash_jobs=server.get("remote_hash_jobs", 1),
+        sync_workers=server.get("sync_workers", 1),
+        sync_mode=server.get("sync_mode", "sftp"),
+        tar_compress=server.get("tar_compress", False),
+        delta_threshold=server.get("delta_threshold"),
+        resume_threshold=server.get("resume_threshold", DEFAULT_RESUME_THRESHOLD),
+        upload_channels=server.get("upload_channels", 1),
+        keepalive=server.get("keepalive", DEFAULT_KEEPALIVE),
+        compare_mode=server.get("compare_mode", "hash"),
+        remote_manifest=server.get("remote_manifest", False),
+        hash_algorithm=server.get("hash_algorithm", DEFAULT_ALGORITHM),
+        detect_moves=server.get("detect_moves", False),
+        max_pending_files=server.get("max_pending_files", DEFAULT_RUN_SIZE),
+    )
+
+
+class FolderComparator:
+    def __init__(self, server_name, flag, ignore_folders, ignore_file_types, changed_files,
+                 hostname, port, username,
+                 key_file_path=None, password=None, local_folder=None,
+                 remote_folder=None, hash_cache=True, force_rehash=False, hash_workers=None,
+                 remote_hash_jobs=1, sync_workers=1, sync_mode='sftp', tar_compress=False,
+                 delta_threshold=None, resume_threshold=DEFAULT_RESUME_THRESHOLD, upload_channels=1,
+                 keepalive=DEFAULT_KEEPALIVE, compare_mode='hash', remote_manifest=False,
+                 hash_algorithm=DEFAULT_ALGORITHM, detect_moves=False, max_pending_files=DEFAULT_RUN_SIZE,
+                 local_files=None, on_log=None, on_data=None):
+        """
+        初始化 FolderComparator 对象。
+
+        :param server_name: 服务器名称
+        :param flag: 操作标志
+        :param hostname: 远程服务器的主机名或IP地址。
+        :param port: 远程服务器的端口号。
+        :param username: 用于连接远程服务器的用户名。
+        :param key_file_path: SSH私钥文件的路径（可选）。
+        :param password: 用户密码（可选）。
+        :param local_folder: 本地文件夹的路径。
+        :param remote_folder: 远程文件夹的路径。
+        :param hash_cache: 是否使用本地哈希缓存。
+        :param force_rehash: 是否忽略缓存，重新计算所有本地文件的哈希值。
+        :param hash_workers: 并行计算本地文件哈希的线程数，默认由线程池决定。
+        :param remote_hash_jobs: 远程并行计算md5的进程数。
+        :param sync_workers: 同步时并行上传/删除使用的SFTP通道数。
+        :param sync_mode: 上传方式，sftp 逐个文件上传，tar 打包成一个tar流上传。
+        :param tar_compress: tar方式上传时是否使用gzip压缩。
+        :param delta_threshold: 不小于这个字节数的不一致文件使用增量上传，为空时不使用。
+        :param resume_threshold: 不小于这个字节数的文件上传到临时文件后改名，中断后可以续传，为空时不使用。
+        :param upload_channels: 上传一个大文件时并行使用的SFTP通道数，文件按范围分段上传。
+        :param keepalive: SSH连接的心跳间隔（秒），保持连接池中的连接不被断开。
+        :param compare_mode: 比较方式，hash 比较md5，quick 先比较文件大小和修改时间，只有修改时间不同的文件才比较md5。
+        :param remote_manifest: 是否在远程文件夹中维护清单文件，刷新时只重新计算变化文件的md5。
+        :param hash_algorithm: 比较文件使用的哈希算法，auto 时选择本地和远程都支持的最快的算法。
+        :param detect_moves: 是否按内容哈希识别移动和复制的文件，同步时在服务器上执行 mv/cp，不再重新上传。
+        :param max_pending_files: 刷新时内存中等待配对的文件数上限，超过后写入临时文件归并比较，为空时不限制。
+        :param local_files: 已经获取的本地文件列表或返回列表的 Future，多个服务器共用同一个本地文件夹时只扫描一次。
+        :param on_log: 日志回调，参数为一条日志。
+        :param on_data: 结果回调，参数为一条刷新/同步结果的字典。
+        """
+
+        self.server_name = server_name
+        self.flag = flag
+        self.changed_files = changed_files
+        self.ignore_folders = ignore_folders
+        self.ignore_file_types = ignore_file_types
+        self.ignore_rules = IgnoreRules(ignore_folders, ignore_file_types)
+
+        self.hostname = hostname
+        self.port = port
+        self.username = username
+        self.key_file_path = key_file_path
+        self.password = password
+        self.keepalive = keepalive
+        self.sftp = None
+        self.connection = None
+        self.transport = None
+        # 正在执行命令的通道，断开时关闭
+        self.channels = set()
+        self.channels_lock = threading.Lock()
+        self.local_folder = local_folder
+        self.remote_folder = remote_folder
+        self.local_files = local_files
+        self.hash_cache = hash_cache
+        self.force_rehash = force_rehash
+        self.hash_workers = hash_workers
+        self.remote_hash_jobs = remote_hash_jobs
+        self.compare_mode = compare_mode
+        self.remote_manifest = remote_manifest
+        self.hash_algorithm = hash_algorithm
+        # 实际使用的哈希算法，auto 时连接后探测确定
+        self.algorithm = None if hash_algorithm == AUTO else get_algorithm(hash_algorithm)
+        self.detect_moves = detect_moves
+        self.max_pending_files = max_pending_files
+        # 远程服务器上是否有某个命令的检查结果
+        self.remote_commands = {}
+        self.sync_workers = sync_workers
+        self.sync_mode = sync_mode
+        self.tar_compress = tar_compress
+        self.delta_threshold = delta_threshold
+        self.resume_threshold = resume_threshold
+        self.upload_channels = upload_channels
+        self.delta_lock = threading.Lock()
+        # 本次同步中已知存在的远程目录
+        self.remote_dirs = set()
+        self.remote_dirs_lock = threading.Lock()
+        self.delta_stats = {'files': 0, 'sent': 0, 'saved': 0}
+        self.cancel_event = threading.Event()
+        self.on_log = on_log
+        self.on_data = on_data
+
+    def connect(self):
+        """
+        连接到远程服务器。
+        同一个服务器的连接保存在连接池中，刷新和同步之间复用；连接失效时自动重连。
+        """
+        from paramiko import SSHException
+
+        try:
+            self.log_emit("连接服务器...")
+            if not self.key_file_path and not self.password:
+                raise ValueError("请配置密码/密钥")
+
+            options = dict(hostname=self.hostname, port=self.port, username=self.username, password=self.password,
+                           key_file_path=self.key_file_path, keepalive=self.keepalive)
+            self.connection, elapsed = connection_pool.acquire(**options)
+            try:
+                self.sftp = self.connection.open_sftp()
+            except (SSHException, EOFError, OSError):
+                if elapsed is not None:
+                    raise
+                # 复用的连接已经失效，重新连接
+                self.connection, elapsed = connection_pool.acquire(reconnect=True, **options)
+                self.sftp = self.connection.open_sftp()
+            self.transport = self.connection.transport
+
+            if elapsed is None:
+                self.log_emit("连接服务器成功! 复用已有连接")
+            else:
+                self.log_emit(f"连接服务器成功! 用时 {elapsed:.2f} 秒")
+        except Exception as e:
+            self.log_emit(f"连接服务器失败: {e}")
+            raise
+
+    def disconnect(self):
+        """
+        关闭本次使用的通道，连接保留在连接池中供下次使用。
+        """
+        with self.channels_lock:
+            channels = list(self.channels)
+        for channel in channels:
+            channel.close()
+        if self.sftp:
+            self.sftp.close()
+            self.sftp = None
+        if self.connection:
+            connection_pool.release(self.connection)
+            self.connection = None
+            self.transport = None
+
+    def log_emit(self, msg):
+        clean_msg = msg.replace(self.remote_folder, '').replace(self.local_folder, '').replace('\\', '/')
+        if self.on_log:
+            self.on_log(f'{self.server_name}, {clean_msg}')
+
+    def data_emit(self, data):
+        if self.on_data:
+            self.on_data(data)
+
+    def open_command(self, command):
+        """
+        通过SSH执行命令，并在后台线程中读取错误输出，避免错误输出占满缓冲区后命令阻塞
+        :param command: 要执行的命令
+        :return: (channel, 错误输出读取线程, 错误输出列表)
+        """
+        channel = self.transport.open_session()
+        with self.channels_lock:
+            self.channels.add(channel)
+        channel.exec_command(command)
+        errors = []
+
+        def read_stderr():
+            for chunk in iter(lambda: channel.recv_stderr(STREAM_CHUNK_SIZE), b''):
+                errors.append(chunk)
+
+        stderr_thread = threading.Thread(target=read_stderr, daemon=True)
+        stderr_thread.start()
+        return channel, stderr_thread, errors
+
+    def close_command(self, channel, stderr_thread, errors, log_errors=True):
+        """
+        等待命令结束，记录错误输出
+        """
+        stderr_thread.join()
+        channel.close()
+        with self.channels_lock:
+            self.channels.discard(channel)
+        error = b''.join(errors).decode(errors='replace')
+        if error and log_errors:
+            self.log_emit(f"命令执行错误: {error}")
+
+    def execute_command(self, command):
+        """
+        通过SSH执行命令
+        :param command: 要执行的命令
+        :return: 命令的输出结果
+        """
+        try:
+            channel, stderr_thread, errors = self.open_command(command)
+            try:
+                output = b''.join(iter(lambda: channel.recv(STREAM_CHUNK_SIZE), b'')).decode()
+            finally:
+                self.close_command(channel, stderr_thread, errors)
+            return output
+        except Exception as e:
+            self.log_emit(f"命令执行失败: {e}")
+            return None
+
+    def execute_command_input(self, command, data):
+        """
+        通过SSH执行命令，并把数据写入命令的标准输入。
+        标准输入在后台线程中写入，同时读取输出，避免输出占满缓冲区后命令不再读取输入，两边互相等待。
+        :param command: 要执行的命令
+        :param data: 写入标准输入的数据
+        :return: (命令的输出结果, 退出码)，执行失败时返回 (None, None)
+        """
+        try:
+            channel, stderr_thread, errors = self.open_command(command)
+            try:
+                write_errors = []
+
+                def write_stdin():
+                    try:
+                        channel.sendall(data)
+                        channel.shutdown_write()
+                    except Exception as e:
+                        write_errors.append(e)
+
+                writer = threading.Thread(target=write_stdin, daemon=True)
+                writer.start()
+                output = b''.join(iter(lambda: channel.recv(STREAM_CHUNK_SIZE), b'')).decode()
+                exit_status = channel.recv_exit_status()
+                writer.join()
+                if write_errors:
+                    raise write_errors[0]
+            finally:
+                self.close_command(channel, stderr_thread, errors)
+            return output, exit_status
+        except Exception as e:
+            self.log_emit(f"命令执行失败: {e}")
+            return None, None
+
+    def execute_command_lines(self, command, separator=b'\n'):
+        """
+        通过SSH执行命令，边接收边按分隔符拆分输出，逐条产出，不缓存全部输出
+        :param command: 要执行的命令
+        :param separator: 输出记录之间的分隔符
+        :return: 生成器，产出解码后的每条记录
+        """
+        channel, stderr_thread, errors = self.open_command(command)
+        try:
+            rest = b''
+            for chunk in iter(lambda: channel.recv(STREAM_CHUNK_SIZE), b''):
+                records = (rest + chunk).split(separator)
+                rest = records.pop()
+                for record in records:
+                    yield record.decode()
+            if rest:
+                yield rest.decode()
+        finally:
+            self.close_command(channel, stderr_thread, errors)
+
+    def resolve_hash_algorithm(self):
+        """
+        确定使用的哈希算法，auto 时探测远程有哪些哈希命令，需要先连接服务器
+
+        :return: HashAlgorithm
+        """
+        if self.algorithm is None:
+            if 'hash_commands' not in self.remote_commands:
+                output = self.execute_command(probe_command())
+                self.remote_commands['hash_commands'] = set((output or '').split())
+            self.algorithm = choose_algorithm(self.remote_commands['hash_commands'], builtin_only=self.remote_manifest)
+            self.log_emit(f'哈希算法: {self.algorithm.name}')
+        return self.algorithm
+
+    def get_digest(self, file_path):
+        """
+        计算本地文件的哈希值。
+
+        :param file_path: 本地文件的路径。
+        :return: 文件的哈希值。
+        """
+        digest = self.algorithm.factory()
+        try:
+            with open(file_path, "rb") as f:
+                if os.fstat(f.fileno()).st_size >= HASH_MMAP_THRESHOLD:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        digest.update(mm)
+                else:
+                    buffer = bytearray(HASH_CHUNK_SIZE)
+                    view = memoryview(buffer)
+                    while size := f.readinto(buffer):
+                        digest.update(view[:size])
+            return digest.hexdigest()
+        except Exception as e:
+            self.log_emit(f"Failed to calculate {self.algorithm.name} for {file_path}: {e}")
+            raise
+
+    def get_all_files(self, local_folder, on_file=None, keep=True):
+        """
+        获取本地文件夹中所有文件的列表。
+
+        :param local_folder: 本地文件夹的路径。
+        :param on_file: 每个文件的哈希值确定后调用，参数为 (全路径, 相对路径, md5)，调用顺序不固定。
+        :param keep: 是否保留文件列表；为 False 时文件交给 on_file 后不再保存，
+                     内存中只有正在计算哈希的文件（不超过线程数的 HASH_QUEUE_PER_WORKER 倍）。
+        :return: 文件的全路径和相对路径的元组列表，keep 为 False 时为 None。
+        """
+        files_list = []
+        count = 0
+        cache = None
+
+        def walk():
+            """
+            遍历本地文件夹，不需要计算哈希的文件直接交给 on_file，
+            需要计算的产出 (在 files_list 中的下标, FileEntry, 文件的 os.stat 结果)，keep 为 False 时下标为 None
+            """
+            nonlocal count
+            rules = self.ignore_rules
+            for root, dirs, files in os.walk(local_folder):
+                self.check_cancelled()
+                relative_root = os.path.relpath(root, local_folder).replace('\\', '/')
+                relative_root = '' if relative_root == '.' else relative_root
+                # 被忽略的文件夹直接从遍历中去掉，不进入
+                rules.prune_dirs(relative_root, dirs)
+                prefix = f'{relative_root}/' if relative_root else ''
+                files = [file for file in files if not rules.ignore_file(file)]
+                count += len(files)
+                if self.compare_mode == 'quick':
+                    # 快速比较只需要文件大小和修改时间
+                    for file in files:
+                        full_path = os.path.join(root, file)
+                        stat_result = os.stat(full_path)
+                        entry = FileEntry(full_path, prefix + file, None, stat_result.st_size, stat_result.st_mtime)
+                        if on_file:
+                            on_file(entry)
+                        if keep:
+                            files_list.append(entry)
+                    continue
+
+                full_paths = [os.path.join(root, file) for file in files]
+                relative_paths = [prefix + file for file in files]
+                stat_results = [None] * len(files)
+                digests = [None] * len(files)
+                if cache:
+                    # 一个文件夹中的文件一起查找缓存
+                    stat_results = [os.stat(full_path) for full_path in full_paths]
+                    digests = cache.lookup_many(list(zip(relative_paths, stat_results)))
+                for full_path, relative_path, stat_result, md5 in zip(full_paths, relative_paths, stat_results,
+                                                                     digests):
+                    entry = FileEntry(full_path, relative_path, md5)
+                    if md5 is None:
+                        yield (len(files_list) if keep else None), entry, stat_result
+                    elif on_file:
+                        on_file(entry)
+                    if keep:
+                        files_list.append(entry)
+
+        try:
+            # 快速比较不计算哈希值，遍历时不使用缓存，否则缓存中的记录都会被当作过期删除
+            if self.hash_cache and self.compare_mode != 'quick':
+                cache = HashCache(get_cache_path(self.server_name), local_folder, self.algorithm.name)
+                if self.force_rehash:
+                    cache.clear()
+
+            hashed = self.hash_local_files(walk(), files_list, cache, on_file)
+            if cache:
+                cache.save()
+            self.log_emit(f"获取本地文件完毕，共 {count} 个，计算哈希 {hashed} 个")
+            return files_list if keep else None
+        except ScanCancelled:
+            raise
+        except Exception as e:
+            self.log_emit(f"Failed to list all files in {local_folder}: {e}")
+            raise
+        finally:
+            if cache:
+                cache.close()
+
+    def hash_local_files(self, jobs, files_list, cache, on_file=None):
+        """
+        使用线程池并行计算本地文件的哈希值，边遍历边计算。
+        同时提交的文件不超过线程数的 HASH_QUEUE_PER_WORKER 倍，计算跟不上时暂停遍历，内存占用和文件总数无关。
+
+        :param jobs: 待计算的文件，(在 files_list 中的下标, FileEntry, os.stat 结果) 的迭代器，下标为 None 时不写回
+        :param files_list: 本地文件列表，计算结果按下标写回，保持原有顺序
+        :param cache: 哈希缓存，为 None 时不记录
+        :param on_file: 每个文件计算完成后调用，参数为 (全路径, 相对路径, md5)
+        :return: 计算哈希的文件数
+        """
+        workers = self.hash_workers or min(32, (os.cpu_count() or 1) + 4)
+        window = workers * HASH_QUEUE_PER_WORKER
+        # 计算完成的 Future 由线程池的回调放入队列，按完成顺序处理
+        finished = queue.SimpleQueue()
+        running = {}
+        done = 0
+        last_report = time.monotonic()
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            jobs = iter(jobs)
+            job = next(jobs, None)
+            while job or running:
+                while job and len(running) < window:
+                    future = executor.submit(self.get_digest, job[1].path)
+                    running[future] = job
+                    future.add_done_callback(finished.put)
+                    job = next(jobs, None)
+
+                future = finished.get()
+                index, entry, stat_result = running.pop(future)
+                entry = entry._replace(digest=future.result())
+                if index is not None:
+                    files_list[index] = entry
+                if cache:
+                    cache.update(entry.relative_path, stat_result, entry.digest)
+                if on_file:
+                    on_file(entry)
+                done += 1
+                self.check_cancelled()
+
+                now = time.monotonic()
+                if now - last_report >= PROGRESS_INTERVAL:
+                    last_report = now
+                    self.log_emit(f"计算本地文件哈希 {done} 个")
+            return done
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    def get_all_remote_files(self, remote_folder):
+        """
+        获取远程文件夹中所有文件的列表
+
+        :param remote_folder: 远程文件夹的路径。
+        :return: 文件的全路径和相对路径的元组列表。
+        """
+        return list(self.iter_remote_files(remote_folder))
+
+    def iter_remote_files(self, remote_folder):
+        """
+        逐个获取远程文件夹中的文件，远程命令输出一行解析一行
+        通过拼接shell命令，一次性获取指定文件夹下所有文件的md5
+        排除了指定文件夹和指定文件类型，文件名以NUL分隔后批量计算md5
+
+        :param remote_folder: 远程文件夹的路径。
+        :return: 生成器，产出 FileEntry，快速比较模式下只有文件大小和修改时间，没有md5
+        """
+        remote_root = remote_folder.rstrip('/') or '/'
+        prefix = remote_root.rstrip('/') + '/'
+
+        self.log_emit('获取远程文件...')
+        count = 0
+        if self.compare_mode == 'quick':
+            # 快速比较只获取文件大小和修改时间
+            command = build_find_command(remote_root, self.ignore_folders, self.ignore_file_types, STAT_ACTION)
+            for record in self.execute_command_lines(command, separator=b'\0'):
+                parsed = parse_stat_record(record)
+                if parsed is None:
+                    continue
+                size, mtime, remote_path = parsed
+                if remote_path.startswith(prefix):
+                    count += 1
+                    yield FileEntry(remote_path, remote_path[len(prefix):], None, size, mtime)
+        else:
+            if self.manifest_available():
+                # 通过远程清单获取哈希值，只计算新增或变化的文件
+                command = manifest_list_command(
+                    build_find_command(remote_root, self.ignore_folders, self.ignore_file_types,
+                                       MANIFEST_STAT_ACTION),
+                    remote_root, self.algorithm.name)
+            else:
+                command = build_checksum_command(
+                    build_find_command(remote_root, self.ignore_folders, self.ignore_file_types),
+                    jobs=self.remote_hash_jobs, hash_command=self.algorithm.command)
+            for line in self.execute_command_lines(command):
+                parsed = parse_checksum_line(line)
+                if parsed is None:
+                    continue
+                md5, remote_path = parsed
+                if remote_path.startswith(prefix):
+                    count += 1
+                    yield FileEntry(remote_path, remote_path[len(prefix):], md5)
+
+        self.log_emit(f'获取远程文件完毕，共 {count} 个')
+
+    def remember_remote_dir(self, remote_directory):
+        """
+        记录已经存在的远程目录及其所有上级目录
+        """
+        with self.remote_dirs_lock:
+            while remote_directory and remote_directory not in self.remote_dirs:
+                self.remote_dirs.add(remote_directory)
+                parent = posixpath.dirname(remote_directory)
+                if parent == remote_directory:
+                    break
+                remote_directory = parent
+
+    def forget_remote_dir(self, remote_directory):
+        """
+        远程目录被删除后不再认为它存在，之后上传到这个目录时重新创建
+        """
+        with self.remote_dirs_lock:
+            self.remote_dirs.discard(remote_directory)
+
+    def prepare_remote_dirs(self, files):
+        """
+        上传前一次性创建所有缺少的远程目录。
+        同步后仍然保留的远程文件（not_same）所在的目录一定存在，不需要创建；要删除的远程文件所在的目录
+        可能在删除后被清理，不作为已知目录；其余目录通过一条 mkdir -p 命令批量创建。
+
+        :param files: 本次同步的文件记录列表
+        """
+        for file in self.changed_files or []:
+            if file['change'] == 'not_same':
+                self.remember_remote_dir(posixpath.dirname(file['remote_file']))
+            elif file['change'] == 'copy':
+                # 复制的来源文件保留，移动的来源文件所在目录可能在同步最后被清理
+                self.remember_remote_dir(posixpath.dirname(file['source_file']))
+
+        missing = sorted({posixpath.dirname(file['remote_file']) for file in files} - self.remote_dirs)
+        if not missing:
+            return
+
+        data = b''.join(directory.encode() + b'\0' for directory in missing)
+        _, exit_status = self.execute_command_input('xargs -0 -r mkdir -p --', data)
+        if exit_status == 0:
+            for directory in missing:
+                self.remember_remote_dir(directory)
+            self.log_emit(f"创建远程文件夹 {len(missing)} 个")
+        else:
+            self.log_emit("批量创建远程文件夹失败，改为逐个创建")
+
+    def create_remote_dir(self, remote_directory, sftp=None):
+        """
+        创建远程目录（包括所有必要的父目录）。
+        已知存在的目录直接返回，不再访问服务器。
+
+        :param remote_directory: 要创建的远程目录的路径。
+        :param sftp: 使用的SFTP客户端，默认 self.sftp
+        """
+        if remote_directory in self.remote_dirs:
+            return
+
+        sftp = sftp or self.sftp
+        directory = remote_directory
+        dirs_to_create = []
+        while directory and directory != self.remote_folder and directory not in self.remote_dirs:
+            try:
+                sftp.stat(directory)
+                break
+            except FileNotFoundError:
+                dirs_to_create.append(directory)
+                directory, _ = posixpath.split(directory)
+
+        while dirs_to_create:
+            dir = dirs_to_create.pop()
+            try:
+                sftp.mkdir(dir)
+            except Exception as e:
+                # 并行上传时目录可能已经被其他线程创建
+                try:
+                    sftp.stat(dir)
+                    continue
+                except FileNotFoundError:
+                    pass
+                self.log_emit(f"Failed to create remote directory {dir}: {e}")
+                raise
+        self.remember_remote_dir(remote_directory)
+
+    def remove_remote_file_and_empty_dirs(self, remote_path, sftp=None):
+        """
+         删除远程文件并递归删除空目录。
+
+         :param remote_path: 要删除的远程文件的路径。
+         :param sftp: 使用的SFTP客户端，默认 self.sftp
+         """
+        sftp = sftp or self.sftp
+        try:
+            sftp.remove(remote_path)
+            self.log_emit(f"删除远程文件 {remote_path}")
+        except Exception as e:
+            self.log_emit(f"Failed to remove remote file {remote_path}: {e}")
+            return False
+
+        remote_root = self.remote_folder.rstrip('/')
+        dir_path = posixpath.dirname(remote_path)
+        while dir_path.startswith(remote_root + '/'):
+            try:
+                if not sftp.listdir(dir_path):
+                    sftp.rmdir(dir_path)
+                    self.forget_remote_dir(dir_path)
+                    self.log_emit(f"删除远程文件夹 {dir_path}")
+                    dir_path = posixpath.dirname(dir_path)
+                else:
+                    break
+            except FileNotFoundError:
+                # 并行删除时目录已经被其他线程删除，继续检查上一级
+                self.forget_remote_dir(dir_path)
+                dir_path = posixpath.dirname(dir_path)
+            except Exception as e:
+                try:
+                    if sftp.listdir(dir_path):
+                        # 其他线程刚刚往目录里写入了文件，目录不再为空
+                        break
+                except FileNotFoundError:
+                    dir_path = posixpath.dirname(dir_path)
+                    continue
+                except Exception:
+                    pass
+                self.log_emit(f"Failed to remove remote directory {dir_path}: {e}")
+                return False
+        return True
+
+    def remove_remote_files_bulk(self, files):
+        """
+        批量删除远程文件，再按从深到浅的顺序一次性删除变空的上级目录（不包括远程文件夹本身）。
+
+        :param files: 需要删除的文件记录列表
+        :return: (文件记录, 是否成功) 列表，无法执行远程命令时返回 None
+        """
+        if not files:
+            return []
+
+        data = b''.join(file['remote_file'].encode() + b'\0' for file in files)
+        output, exit_status = self.execute_command_input(BULK_REMOVE_COMMAND, data)
+        if exit_status != 0:
+            self.log_emit('批量删除远程文件失败，改为逐个删除')
+            return None
+
+        failed = set(output.split('\0'))
+        results = []
+        for file in files:
+            remote_file = file['remote_file']
+            if remote_file in failed:
+                self.log_emit(f"Failed to remove remote file {remote_file}")
+                results.append((file, False))
+                continue
+            self.log_emit(f"删除远程文件 {remote_file}")
+            results.append((file, True))
+
+        self.prune_remote_dirs([file['remote_file'] for file, flag in results if flag])
+        return results
+
+    def prune_remote_dirs(self, remote_paths):
+        """
+        按从深到浅的顺序一次性删除这些文件变空的上级目录（不包括远程文件夹本身）
+
+        :param remote_paths: 已经删除或移走的远程文件路径列表
+        """
+        dirs = set()
+        remote_root = self.remote_folder.rstrip('/')
+        for remote_path in remote_paths:
+            dir_path = posixpath.dirname(remote_path)
+            while dir_path.startswith(remote_root + '/') and dir_path not in dirs:
+                dirs.add(dir_path)
+                dir_path = posixpath.dirname(dir_path)
+        if not dirs:
+            return
+
+        # 子目录排在上级目录前面，一次遍历就能删除整条空目录链
+        ordered = sorted(dirs, key=lambda path: path.count('/'), reverse=True)
+        data = b''.join(path.encode() + b'\0' for path in ordered)
+        output, _ = self.execute_command_input(PRUNE_DIRS_COMMAND, data)
+        for dir_path in (output or '').split('\0'):
+            if dir_path:
+                self.forget_remote_dir(dir_path)
+                self.log_emit(f"删除远程文件夹 {dir_path}")
+
+    def copy_remote_files(self, files, change):
+        """
+        在服务器上批量复制或移动文件，所有文件在一个 sh 进程中执行，不需要重新上传。
+        快速比较模式下把目标文件的修改时间设置为本地文件的修改时间。
+
+        :param files: change 为 copy/move 的文件记录列表
+        :param change: copy/move
+        :return: (文件记录, 是否成功) 列表
+        """
+        if not files:
+            return []
+
+        command = REMOTE_COPY_COMMANDS[change]
+        script = ''.join(
+            f"{command} {shlex.quote(file['source_file'])} {shlex.quote(file['remote_file'])} 2>/dev/null "
+            f"|| printf '%s\\0' {shlex.quote(file['remote_file'])}\n" for file in files)
+        output, exit_status = self.execute_command_input('sh -s', script.encode())
+        if output is None:
+            return [(file, False) for file in files]
+
+        failed = set(output.split('\0'))
+        action = '复制' if change == 'copy' else '移动'
+        results = []
+        for file in files:
+            if file['remote_file'] in failed:
+                self.log_emit(f"Failed to {change} remote file {file['source_file']} --> {file['remote_file']}")
+                results.append((file, False))
+                continue
+            if self.compare_mode == 'quick':
+                try:
+                    stat_result = os.stat(file['local_file'])
+                    self.sftp.utime(file['remote_file'], (stat_result.st_atime, stat_result.st_mtime))
+                except Exception as e:
+                    self.log_emit(f"Failed to set mtime of {file['remote_file']}: {e}")
+            self.log_emit(f"远程{action}文件: {file['source_file']} --> {file['remote_file']}")
+            results.append((file, True))
+        return results
+
+    def upload_file(self, local_file, remote_file, sftp=None):
+        """
+        上传本地文件到远程服务器。
+
+        :param local_file: 本地文件的路径。
+        :param remote_file: 远程文件的路径。
+        :param sftp: 使用的SFTP客户端，默认 self.sftp
+        """
+        sftp = sftp or self.sftp
+        remote_dir = posixpath.dirname(remote_file)
+        try:
+            self.create_remote_dir(remote_dir, sftp)
+            if self.resume_threshold is not None and os.path.getsize(local_file) >= self.resume_threshold:
+                self.upload_file_atomic(local_file, remote_file, sftp)
+            else:
+                sftp.put(local_file, remote_file)
+            if self.compare_mode == 'quick':
+                # 保持和本地文件相同的修改时间，下次快速比较时可以直接判断为相同
+                stat_result = os.stat(local_file)
+                sftp.utime(remote_file, (stat_result.st_atime, stat_result.st_mtime))
+            self.log_emit(
+                f'上传文件: {local_file} --> {remote_file}')
+            return True
+        except Exception as e:
+            self.log_emit(f"Failed to upload file {local_file} --> {remote_file}: {e}")
+            return False
+
+    def upload_file_atomic(self, local_file, remote_file, sftp):
+        """
+        上传大文件：先写入同一目录下的临时文件，上传完成后原子替换目标文件，
+        上传过程中目标文件始终是完整的旧版本。中断后下次上传从临时文件的大小继续。
+
+        :param local_file: 本地文件的路径。
+        :param remote_file: 远程文件的路径。
+        :param sftp: 使用的SFTP客户端
+        """
+        size = os.path.getsize(local_file)
+        temp_file = upload_temp_path(remote_file)
+        parts = min(self.upload_channels or 1, size // UPLOAD_MIN_PART_SIZE)
+        if parts > 1:
+            bounds = [size * index // parts for index in range(parts + 1)]
+            self.upload_ranges(local_file, temp_file, list(zip(bounds, bounds[1:])), sftp)
+        else:
+            self.upload_resumable(local_file, temp_file, size, sftp)
+
+        uploaded = sftp.stat(temp_file).st_size
+        if uploaded != size:
+            raise IOError(f'上传后的文件大小不一致 {uploaded}/{size}')
+        self.replace_remote_file(temp_file, remote_file, sftp)
+
+    def upload_resumable(self, local_file, temp_file, size, sftp):
+        """
+        从临时文件已有的大小继续上传，连接仍然可用时中断后重试
+
+        :param size: 本地文件大小
+        """
+        for attempt in range(UPLOAD_RETRIES + 1):
+            offset = self.resume_offset(local_file, temp_file, size, sftp)
+            if offset:
+                self.log_emit(f'断点续传 {local_file}，从 {offset}/{size} 字节继续')
+            try:
+                self.write_range(local_file, temp_file, offset, size, sftp, 'r+b' if offset else 'wb')
+                return
+            except Exception as e:
+                if attempt == UPLOAD_RETRIES or not self.transport or not self.transport.is_active():
+                    raise
+                self.log_emit(f'上传中断，重试 {local_file}: {e}')
+
+    def resume_offset(self, local_file, temp_file, size, sftp):
+        """
+        可以继续上传的位置。临时文件可能来自本地文件的旧版本，已上传部分的md5和本地一致时才续传。
+
+        :return: 续传的起始字节，需要重新上传时为 0
+        """
+        try:
+            offset = sftp.stat(temp_file).st_size
+        except IOError:
+            return 0
+        if not offset or offset > size:
+            return 0
+
+        output = self.execute_command(f'head -c {offset} -- {shlex.quote(temp_file)} | md5sum')
+        remote_md5 = output.split()[0] if output else None
+        return offset if remote_md5 and remote_md5 == local_range_md5(local_file, 0, offset) else 0
+
+    def resume_ranges(self, local_file, temp_file, ranges, sftp):
+        """
+        分段上传时每段可以继续上传的范围。分段并行写入临时文件，文件大小不代表已上传的位置，
+        每段按 RESUME_BLOCK_SIZE 分块比较md5，从第一个和本地不一致的块继续上传。
+
+        :param ranges: (起始字节, 结束字节) 列表，最后一段的结束字节是本地文件大小
+        :return: 还需要上传的 (起始字节, 结束字节) 列表，临时文件不能续传时为 None
+        """
+        try:
+            uploaded = sftp.stat(temp_file).st_size
+        except IOError:
+            return None
+        if not uploaded or uploaded > ranges[-1][1]:
+            return None
+        blocks = [(offset, min(offset + RESUME_BLOCK_SIZE, end)) for start, end in ranges
+                  for offset in range(start, end, RESUME_BLOCK_SIZE)]
+        blocks = [block for block in blocks if block[1] <= uploaded]
+        if not blocks:
+            return None
+
+        quoted = shlex.quote(temp_file)
+        output = self.execute_command('; '.join(
+            f'tail -c +{start + 1} -- {quoted} | head -c {end - start} | md5sum' for start, end in blocks))
+        remote_md5s = [line.split()[0] for line in (output or '').splitlines() if line.strip()]
+        if len(remote_md5s) != len(blocks):
+            return None
+        verified = {block for block, remote_md5 in zip(blocks, remote_md5s)
+                    if remote_md5 == local_range_md5(local_file, *block)}
+
+        remaining = []
+        for start, end in ranges:
+            offset = start
+            while offset < end and (offset, min(offset + RESUME_BLOCK_SIZE, end)) in verified:
+                offset = min(offset + RESUME_BLOCK_SIZE, end)
+            if offset < end:
+                remaining.append((offset, end))
+        return remaining
+
+    def write_range(self, local_file, remote_file, start, end, sftp, mode):
+        """
+        把本地文件 [start, end) 范围内的数据写入远程文件的相同位置，写请求流水线发送，不逐个等待确认
+
+        :param mode: 远程文件的打开方式，wb 新建，r+b 写入已有文件
+        """
+        with open(local_file, 'rb') as source, sftp.open(remote_file, mode, UPLOAD_CHUNK_SIZE) as target:
+            target.set_pipelined(True)
+            source.seek(start)
+            target.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = source.read(min(UPLOAD_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise IOError(f'本地文件在上传过程中变小了: {local_file}')
+                target.write(chunk)
+                remaining -= len(chunk)
+
+    def upload_ranges(self, local_file, temp_file, ranges, sftp):
+        """
+        一个大文件按范围分段，每段使用单独的SFTP通道并行上传，失败的分段在连接可用时重新上传。
+        上次同步中断时留下的临时文件，每段从已上传的位置继续。
+
+        :param ranges: (起始字节, 结束字节) 列表
+        :param sftp: 第一段使用的SFTP客户端，其余分段打开新的通道
+        """
+        pending = self.resume_ranges(local_file, temp_file, ranges, sftp)
+        if pending is None:
+            pending = ranges
+            with sftp.open(temp_file, 'wb'):
+                pass
+        else:
+            remaining = sum(end - start for start, end in pending)
+            self.log_emit(f'断点续传 {local_file}，还需上传 {remaining}/{ranges[-1][1]} 字节')
+            if not pending:
+                return
+        self.log_emit(f'分 {len(pending)} 段并行上传 {local_file}')
+
+        for attempt in range(UPLOAD_RETRIES + 1):
+            pool, opened = self.open_sftp_pool(len(pending), sftp)
+
+            def run(part):
+                channel = pool.get()
+                try:
+                    self.write_range(local_file, temp_file, part[0], part[1], channel, 'r+b')
+                finally:
+                    pool.put(channel)
+
+            try:
+                with ThreadPoolExecutor(max_workers=len(opened) + 1) as executor:
+                    futures = {executor.submit(run, part): part for part in pending}
+                    errors = {futures[future]: future.exception() for future in as_completed(futures)}
+            finally:
+                for channel in opened:
+                    channel.close()
+
+            failed = [part for part in pending if errors[part] is not None]
+            if not failed:
+                return
+            error = errors[failed[0]]
+            if attempt == UPLOAD_RETRIES or not self.transport or not self.transport.is_active():
+                raise error
+            self.log_emit(f'{len(failed)} 个分段上传失败，重试 {local_file}: {error}')
+            pending = failed
+
+    def replace_remote_file(self, temp_file, remote_file, sftp):
+        """
+        临时文件改名为目标文件，保留目标文件原来的权限
+        """
+        try:
+            sftp.chmod(temp_file, stat.S_IMODE(sftp.stat(remote_file).st_mode))
+        except IOError:
+            pass
+        try:
+            sftp.posix_rename(temp_file, remote_file)
+        except IOError:
+            # 服务器不支持 posix-rename 扩展时，先删除目标文件再改名
+            try:
+                sftp.remove(remote_file)
+            except IOError:
+                pass
+            sftp.rename(temp_file, remote_file)
+
+    def open_sftp_pool(self, size, first=None):
+        """
+        在同一个SSH连接上打开多个SFTP通道，第一个通道是 first，默认 self.sftp
+
+        :param size: 通道数量
+        :param first: 已经打开的第一个通道
+        :return: 通道队列和新打开的通道列表
+        """
+        pool = queue.Queue()
+        pool.put(first or self.sftp)
+        opened = []
+        for _ in range(size - 1):
+            try:
+                sftp = self.connection.open_sftp()
+            except Exception as e:
+                # 服务器限制了会话数量时，使用已经打开的通道继续
+                self.log_emit(f"打开SFTP通道失败，使用 {len(opened) + 1} 个通道同步: {e}")
+                break
+            opened.append(sftp)
+            pool.put(sftp)
+        return pool, opened
+
+    def run_sync_tasks(self, task, files):
+        """
+        使用多个SFTP通道并行执行同步任务
+
+        :param task: 同步函数，参数为 (文件记录, SFTP客户端)，返回是否成功
+        :param files: 文件记录列表
+        :return: 生成器，每个任务完成时产出 (文件记录, 是否成功)
+        """
+        workers = min(self.sync_workers or 1, len(files))
+        if workers <= 1:
+            for file in files:
+                yield file, task(file, self.sftp)
+            return
+
+        pool, opened = self.open_sftp_pool(workers)
+
+        def run(file):
+            sftp = pool.get()
+            try:
+                return task(file, sftp)
+            finally:
+                pool.put(sftp)
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(opened) + 1) as executor:
+                futures = {executor.submit(run, file): file for file in files}
+                for future in as_completed(futures):
+                    yield futures[future], future.result()
+        finally:
+            for sftp in opened:
+                sftp.close()
+
+    def remote_command_available(self, name):
+        """
+        检查远程服务器上是否有指定的命令
+
+        :param name: 命令名称
+        :return: True 有 False 没有
+        """
+        if name not in self.remote_commands:
+            output = self.execute_command(f'command -v {shlex.quote(name)}')
+            self.remote_commands[name] = bool(output and output.strip())
+        return self.remote_commands[name]
+
+    def manifest_available(self):
+        """
+        是否可以使用远程清单，清单由远程 python3 计算，只支持 hashlib 中的算法
+        """
+        return bool(self.remote_manifest and self.algorithm.builtin and self.remote_command_available('python3'))
+
+    def upload_files_tar(self, files):
+        """
+        把多个文件打包成一个tar流，通过SSH直接解压到远程文件夹，省去逐个文件的SFTP往返。
+
+        本地文件无法读取时只标记这个文件失败；远程没有tar命令或者解压失败时返回 None，
+        由调用方改为逐个文件通过SFTP上传。
+
+        :param files: 需要上传的文件记录列表
+        :return: (文件记录, 是否成功) 列表，无法使用tar时返回 None
+        """
+        if not self.remote_command_available('tar'):
+            self.log_emit('远程服务器没有tar命令，改为逐个文件上传')
+            return None
+
+        remote_root = self.remote_folder.rstrip('/') or '/'
+        flags = '-xzf' if self.tar_compress else '-xf'
+        command = f'tar {flags} - --no-same-owner -C {shlex.quote(remote_root)}'
+
+        def reset_owner(tarinfo):
+            tarinfo.uid = tarinfo.gid = 0
+            tarinfo.uname = tarinfo.gname = ''
+            return tarinfo
+
+        results = []
+        channel, stderr_thread, errors = self.open_command(command)
+        try:
+            with channel.makefile('wb', TAR_BUFFER_SIZE) as stream:
+                output = gzip.GzipFile(fileobj=stream, mode='wb', compresslevel=6) if self.tar_compress else stream
+                with tarfile.open(fileobj=output, mode='w|', bufsize=TAR_BUFFER_SIZE) as tar:
+                    for file in files:
+                        try:
+                            tar.add(file['local_file'], arcname=file['path'], recursive=False, filter=reset_owner)
+                        except OSError as e:
+                            # 文件在打开前就失败，tar流中不会留下这个文件的任何内容
+                            self.log_emit(f"Failed to read local file {file['local_file']}: {e}")
+                            results.append((file, False))
+                        else:
+                            results.append((file, True))
+                if self.tar_compress:
+                    output.close()
+            channel.shutdown_write()
+            exit_status = channel.recv_exit_status()
+        except Exception as e:
+            self.log_emit(f"tar上传失败，改为逐个文件上传: {e}")
+            return None
+        finally:
+            self.close_command(channel, stderr_thread, errors)
+
+        if exit_status != 0:
+            self.log_emit(f"远程tar解压失败(退出码 {exit_status})，改为逐个文件上传")
+            return None
+
+        for file, flag in results:
+            if flag:
+                self.log_emit(f"上传文件: {file['local_file']} --> {file['remote_file']}")
+        return results
+
+    def split_delta_uploads(self, uploads):
+        """
+        分出需要增量上传的文件：远程已有同名文件，本地文件不小于 delta_threshold，并且远程有python3
+
+        :param uploads: 需要上传的文件记录列表
+        :return: (完整上传的文件记录列表, 增量上传的文件记录列表)
+        """
+        if not self.delta_threshold:
+            return uploads, []
+
+        full, delta = [], []
+        for file in uploads:
+            try:
+                selected = (file['change'] == 'not_same'
+                            and os.path.getsize(file['local_file']) >= self.delta_threshold)
+            except OSError:
+                selected = False
+            (delta if selected else full).append(file)
+
+        if delta and not self.remote_command_available('python3'):
+            self.log_emit('远程服务器没有python3，不使用增量上传')
+            return uploads, []
+        return full, delta
+
+    def upload_file_delta(self, local_file, remote_file, sftp=None):
+        """
+        增量上传本地文件，只发送和远程文件不同的数据块，无法增量上传时改为完整上传。
+
+        :param local_file: 本地文件的路径。
+        :param remote_file: 远程文件的路径。
+        :param sftp: 完整上传时使用的SFTP客户端，默认 self.sftp
+        """
+        try:
+            sent = self.transfer_delta(local_file, remote_file)
+        except Exception as e:
+            self.log_emit(f"增量上传失败，改为完整上传 {local_file}: {e}")
+            sent = None
+        if sent is None:
+            return self.upload_file(local_file, remote_file, sftp)
+
+        size = os.path.getsize(local_file)
+        with self.delta_lock:
+            self.delta_stats['files'] += 1
+            self.delta_stats['sent'] += sent
+            self.delta_stats['saved'] += max(size - sent, 0)
+        self.log_emit(f'增量上传文件: {local_file} --> {remote_file}，发送 {sent}/{size} 字节')
+        return True
+
+    def transfer_delta(self, local_file, remote_file):
+        """
+        获取远程文件的块签名，计算增量数据并发送给远程辅助脚本，由远程脚本生成新文件后原子替换。
+
+        :return: 发送的字节数，增量数据太多不划算时返回 None
+        """
+        size = os.path.getsize(local_file)
+        block_size = choose_block_size(size)
+        output = self.execute_command(signature_command(remote_file, block_size))
+        if not output:
+            return None
+
+        encoder = DeltaEncoder(parse_signatures(output), block_size, int(size * DELTA_MAX_LITERAL_RATIO))
+        with open(local_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            expected = hashlib.md5(data).hexdigest()
+            mtime = os.fstat(f.fileno()).st_mtime
+            channel, stderr_thread, errors = self.open_command(
+                patch_command(remote_file, block_size, expected, mtime))
+            sent = 0
+            aborted = False
+            try:
+                with channel.makefile('wb', TAR_BUFFER_SIZE) as stream:
+                    try:
+                        for chunk in encoder.encode(data):
+                            stream.write(chunk)
+                            sent += len(chunk)
+                    except DeltaTooLarge:
+                        # 不发送结束指令，远程脚本读到流结束后删除临时文件，旧文件保持不变
+                        aborted = True
+                channel.shutdown_write()
+                reply = b''.join(iter(lambda: channel.recv(STREAM_CHUNK_SIZE), b''))
+                exit_status = channel.recv_exit_status()
+            finally:
+                channel.shutdown_write()
+                self.close_command(channel, stderr_thread, errors, log_errors=not aborted)
+
+        if aborted:
+            self.log_emit(f'{local_file} 变化太多，改为完整上传')
+            return None
+
+        if exit_status != 0 or reply.strip() != b'ok':
+            raise RuntimeError(f'远程合并失败(退出码 {exit_status})')
+        return sent
+
+    def update_remote_manifest(self, paths):
+        """
+        同步后更新远程清单中这些文件的记录，下次刷新时不需要重新计算它们的哈希值
+
+        :param paths: 已经同步的文件相对路径列表
+        """
+        self.resolve_hash_algorithm()
+        if not self.manifest_available():
+            return
+        remote_root = self.remote_folder.rstrip('/') or '/'
+        data = b''.join(path.encode() + b'\0' for path in paths)
+        _, exit_status = self.execute_command_input(manifest_update_command(remote_root, self.algorithm.name), data)
+        if exit_status == 0:
+            self.log_emit(f'更新远程清单，共 {len(paths)} 个文件')
+        else:
+            self.log_emit('更新远程清单失败')
+
+    def sync_files(self):
+        """
+       比较本地和远程文件夹，并同步不同的文件。
+       先在服务器上复制和移动文件，复制在移动之前，来源文件都还在原来的位置；
+       再并行上传，全部上传完成后再并行删除，最后清理移动后变空的目录，避免删除空目录时和上传冲突。
+
+       :return: 同步失败的文件数
+       """
+        self.connect()
+
+        fail_count = 0
+        try:
+            if self.changed_files:
+                uploads = [file for file in self.changed_files if file['change'] in ('not_same', 'local')]
+                removals = [file for file in self.changed_files if file['change'] == 'remote']
+                copies = [file for file in self.changed_files if file['change'] == 'copy']
+                moves = [file for file in self.changed_files if file['change'] == 'move']
+
+                self.prepare_remote_dirs(copies + moves)
+                copy_results = self.copy_remote_files(copies, 'copy')
+                move_results = self.copy_remote_files(moves, 'move')
+
+                uploads, delta_uploads = self.split_delta_uploads(uploads)
+
+                upload_results = None
+                if self.sync_mode == 'tar' and uploads:
+                    upload_results = self.upload_files_tar(uploads)
+                if upload_results is None:
+                    self.prepare_remote_dirs(uploads)
+                    upload_results = self.run_sync_tasks(
+                        lambda file, sftp: self.upload_file(file['local_file'], file['remote_file'], sftp), uploads)
+                delta_results = self.run_sync_tasks(
+                    lambda file, sftp: self.upload_file_delta(file['local_file'], file['remote_file'], sftp),
+                    delta_uploads)
+
+                # run_sync_tasks 是生成器，先取完上传结果（上传全部完成）再删除，删除空目录时不会和上传冲突
+                synced = []
+                for results in (copy_results, move_results, upload_results, delta_results):
+                    fail_count += self.report_sync_results(results, synced)
+
+                remove_results = self.remove_remote_files_bulk(removals)
+                if remove_results is None:
+                    remove_results = self.run_sync_tasks(
+                        lambda file, sftp: self.remove_remote_file_and_empty_dirs(file['remote_file'], sftp), removals)
+                fail_count += self.report_sync_results(remove_results, synced)
+                # 上传和删除全部完成后，最后清理移动后变空的来源目录
+                self.prune_remote_dirs([file['source_file'] for file, flag in move_results if flag])
+
+                if self.remote_manifest and synced:
+                    self.update_remote_manifest(synced)
+        finally:
+            self.disconnect()
+            all_count = len(self.changed_files)
+            self.log_emit(f'同步完毕，共 {all_count} 个文件，成功 {all_count - fail_count} 个，失败 {fail_count} 个')
+            if self.delta_stats['files']:
+                self.log_emit(f"增量上传 {self.delta_stats['files']} 个文件，发送 {self.delta_stats['sent']} 字节，"
+                              f"节省 {self.delta_stats['saved']} 字节")
+        return fail_count
+
+    def report_sync_results(self, results, synced):
+        """
+        逐个发送同步结果到界面
+
+        :param results: (文件记录, 是否成功) 序列
+        :param synced: 同步成功的文件相对路径列表，成功的文件加入其中
+        :return: 同步失败的文件数
+        """
+        fail_count = 0
+        for file, flag in results:
+            self.data_emit({'type': 'sync', 'server': self.server_name, 'path': file['path'], 'status': flag})
+            if flag:
+                synced.append(file['path'])
+            else:
+                fail_count += 1
+        return fail_count
+
+    def emit_change(self, change, relative_path, local_file, remote_file):
+        """
+        发送一条刷新结果到界面
+
+        :param change: 不一致类型，not_same/local/remote/move/copy
+        :param relative_path: 文件的相对路径
+        :param local_file: 本地文件元组，远程独有时为 None
+        :param remote_file: 远程文件元组，本地独有时为 None；move/copy 时为远程的源文件
+        """
+        data = {
+            'type': 'refresh',
+            'server': self.server_name,
+            'path': relative_path,
+            'local_file': local_file[0] if local_file else None,
+            'change': change,
+        }
+        if change in ('local', 'move', 'copy'):
+            data['remote_file'] = posixpath.join(self.remote_folder, relative_path)
+        else:
+            data['remote_file'] = remote_file[0]
+        if change in ('move', 'copy'):
+            data['source_file'] = remote_file[0]
+            data['source_path'] = remote_file[1]
+        self.data_emit(data)
+
+    def check_cancelled(self):
+        """
+        刷新被取消时抛出 ScanCancelled
+        """
+        if self.cancel_event.is_set():
+            raise ScanCancelled()
+
+    def cancel(self):
+        """
+        取消正在进行的刷新，本地和远程的扫描都会尽快停止
+        """
+        self.cancel_event.set()
+
+    def run_scan(self, side, scan, results):
+        """
+        在后台线程中执行一侧的扫描，文件、完成和异常都放入结果队列
+
+        :param side: local/remote
+        :param scan: 扫描函数，参数为每个文件的回调
+        :param results: 结果队列，元素为 (side, kind, payload)，kind 取值 file/done/error
+        """
+        try:
+            scan(lambda file: results.put((side, 'file', file)))
+            results.put((side, 'done', None))
+        except BaseException as e:
+            self.cancel_event.set()
+            results.put((side, 'error', e))
+
+    def scan_local_files(self, on_file):
+        """
+        扫描本地文件，每个文件调用一次 on_file；已经有本地文件列表时直接使用
+        """
+        if self.local_files is None:
+            self.get_all_files(self.local_folder, on_file, keep=False)
+            return
+        local_files = self.local_files
+        if isinstance(local_files, Future):
+            local_files = local_files.result()
+        for local_file in local_files:
+            self.check_cancelled()
+            on_file(local_file)
+
+    def scan_remote_files(self, on_file):
+        """
+        扫描远程文件，每个文件调用一次 on_file
+        """
+        try:
+            for remote_file in self.iter_remote_files(self.remote_folder):
+                self.check_cancelled()
+                on_file(remote_file)
+        except ScanCancelled:
+            raise
+        except Exception as e:
+            if self.cancel_event.is_set():
+                # 另一侧出错或刷新被取消时连接已断开，不再重复报错
+                raise ScanCancelled() from e
+            self.log_emit(f"获取远程文件失败: {e}")
+            raise
+
+    def check_changes(self, records):
+        """
+        快速比较中大小相同但修改时间不同的文件，计算两侧的md5后再比较
+
+        :param records: change 为 check 的差异记录列表
+        :return: 内容不一致的差异记录列表
+        """
+        if not records:
+            return []
+
+        self.log_emit(f'修改时间不一致的文件 {len(records)} 个，比较md5...')
+        remote_md5 = self.get_remote_digests([remote_file.path for _, _, _, remote_file in records])
+        local_md5 = self.get_local_digests([local_file for _, _, local_file, _ in records])
+
+        changes = []
+        same = []
+        for (_, relative_path, local_file, remote_file), md5 in zip(records, local_md5):
+            if remote_md5.get(remote_file.path) != md5:
+                changes.append(('not_same', relative_path, local_file._replace(digest=md5),
+                                remote_file._replace(digest=remote_md5.get(remote_file.path))))
+            else:
+                same.append((remote_file.path, local_file.mtime))
+        # 内容相同的文件把远程修改时间改成和本地一致，下次快速比较时直接判断为相同，不再计算md5
+        self.set_remote_mtimes(same)
+        return changes
+
+    def set_remote_mtimes(self, files):
+        """
+        设置远程文件的修改时间，和同步一样使用 sync_workers 个SFTP通道并行设置
+
+        :param files: (远程文件全路径, 修改时间) 列表
+        """
+        if not files:
+            return
+
+        def set_mtime(file, sftp):
+            remote_file, mtime = file
+            try:
+                sftp.utime(remote_file, (mtime, mtime))
+                return True
+            except Exception as e:
+                self.log_emit(f"Failed to set mtime of {remote_file}: {e}")
+                return False
+
+        updated = sum(flag for _, flag in self.run_sync_tasks(set_mtime, files))
+        self.log_emit(f'内容相同的文件 {len(files)} 个，更新远程修改时间 {updated} 个')
+
+    def get_remote_digests(self, paths):
+        """
+        一次性计算多个远程文件的哈希值
+
+        :param paths: 远程文件的全路径列表
+        :return: 远程文件全路径 -> 哈希值
+        """
+        data = b''.join(path.encode() + b'\0' for path in paths)
+        output, exit_status = self.execute_command_input(f'xargs -0 -r {self.algorithm.command} --', data)
+        if output is None:
+            raise RuntimeError('获取远程文件md5失败')
+        return dict(reversed(parsed) for parsed in map(parse_checksum_line, output.split('\n')) if parsed)
+
+    def get_local_digests(self, local_files):
+        """
+        并行计算多个本地文件的哈希值，开启哈希缓存时先查缓存，新计算的哈希值写回缓存
+
+        :param local_files: 本地文件 FileEntry 列表
+        :return: 和 local_files 顺序一致的哈希值列表
+        """
+        digests = [None] * len(local_files)
+        stat_results = [None] * len(local_files)
+        cache = None
+        try:
+            if self.hash_cache:
+                cache = HashCache(get_cache_path(self.server_name), self.local_folder, self.algorithm.name)
+                stat_results = [os.stat(local_file.path) for local_file in local_files]
+                if not self.force_rehash:
+                    digests = cache.lookup_many([(local_file.relative_path, stat_result)
+                                                 for local_file, stat_result in zip(local_files, stat_results)])
+
+            pending = [index for index, digest in enumerate(digests) if digest is None]
+            with ThreadPoolExecutor(max_workers=self.hash_workers) as executor:
+                for index, digest in zip(pending, executor.map(
+                        self.get_digest, [local_files[index].path for index in pending])):
+                    digests[index] = digest
+                    if cache:
+                        cache.update(local_files[index].relative_path, stat_results[index], digest)
+            if cache:
+                # 只计算了部分文件，不删除其他记录
+                cache.save(prune=False)
+            return digests
+        finally:
+            if cache:
+                cache.close()
+
+    def hash_move_candidates(self, records, remote_files):
+        """
+        快速比较时只有一侧存在的文件没有哈希值，只计算两侧有相同大小的文件的哈希值
+
+        :param records: 只有一侧存在的差异记录列表
+        :param remote_files: 远程文件哈希值 -> 远程文件元组，加入计算过哈希值的远程文件
+        :return: 候选文件带上哈希值后的差异记录列表
+        """
+        local_sizes = {local_file.size for change, _, local_file, _ in records if change == 'local'}
+        remote_sizes = {remote_file.size for change, _, _, remote_file in records if change == 'remote'}
+        # 空文件上传的代价很小，不参与配对
+        sizes = (local_sizes & remote_sizes) - {0}
+        if not sizes:
+            return records
+
+        local_indexes = [index for index, (change, _, local_file, _) in enumerate(records)
+                         if change == 'local' and local_file.size in sizes]
+        remote_indexes = [index for index, (change, _, _, remote_file) in enumerate(records)
+                          if change == 'remote' and remote_file.size in sizes]
+        self.log_emit(f'大小相同的新增和删除文件 {len(local_indexes) + len(remote_indexes)} 个，计算哈希值...')
+        remote_digests = self.get_remote_digests([records[index][3].path for index in remote_indexes])
+        local_digests = self.get_local_digests([records[index][2] for index in local_indexes])
+
+        records = list(records)
+        for index, digest in zip(local_indexes, local_digests):
+            change, relative_path, local_file, remote_file = records[index]
+            records[index] = (change, relative_path, local_file._replace(digest=digest), remote_file)
+        for index in remote_indexes:
+            change, relative_path, local_file, remote_file = records[index]
+            remote_file = remote_file._replace(digest=remote_digests.get(remote_file.path))
+            records[index] = (change, relative_path, local_file, remote_file)
+            if remote_file.digest:
+                remote_files.setdefault(remote_file.digest, remote_file)
+        return records
+
+    def find_moves(self, records, remote_files):
+        """
+        按内容哈希把只有一侧存在的文件转换为远程移动和复制
+
+        :param records: 只有一侧存在的差异记录列表
+        :param remote_files: 远程文件哈希值 -> 远程文件元组；快速比较时只有大小相同的候选文件能配对
+        :return: 差异记录列表
+        """
+        if not records:
+            return []
+        if self.compare_mode == 'quick':
+            records = self.hash_move_candidates(records, remote_files)
+        records = detect_moves(records, remote_files, skip_digest=self.algorithm.factory().hexdigest())
+        moves = sum(1 for record in records if record[0] == 'move')
+        copies = sum(1 for record in records if record[0] == 'copy')
+        if moves or copies:
+            self.log_emit(f'识别出移动的文件 {moves} 个，远程已有相同内容的文件 {copies} 个')
+        return records
+
+    def create_manifest(self, side):
+        """
+        刷新时等待配对的文件太多，创建保存在临时文件中的有序清单
+
+        :param side: local/remote
+        """
+        if side == 'local':
+            self.log_emit(f'等待比较的文件超过 {self.max_pending_files} 个，改为写入临时文件后归并比较')
+            return SortedManifest(self.local_folder, os.path.join, self.max_pending_files)
+        return SortedManifest(self.remote_folder.rstrip('/') or '/', posixpath.join, self.max_pending_files)
+
+    def collect_change(self, record, to_check, one_sided):
+        """
+        处理一条差异记录：需要比较哈希值的放入 to_check，识别移动时只有一侧存在的放入 one_sided，其余直接发送
+
+        :return: 发送的记录数
+        """
+        if record[0] == 'check':
+            to_check.append(record)
+        elif self.detect_moves and record[0] != 'not_same':
+            one_sided.append(record)
+        else:
+            self.emit_change(*record)
+            return 1
+        return 0
+
+    def refresh_files(self):
+        """
+       比较本地和远程文件夹，并同步不同的文件。
+       本地文件哈希和远程文件md5在两个线程中同时进行，结果边到达边比较。
+       等待配对的文件超过 max_pending_files 个时，改为写入临时文件，扫描结束后归并比较。
+
+       :return: 需要处理的文件数
+       """
+        self.connect()
+        self.resolve_hash_algorithm()
+        change_count = 0
+        diff = None
+        results = queue.Queue()
+        scans = [
+            threading.Thread(target=self.run_scan, daemon=True, args=(
+                'local', self.scan_local_files, results)),
+            threading.Thread(target=self.run_scan, daemon=True, args=(
+                'remote', self.scan_remote_files, results)),
+        ]
+        try:
+            for scan in scans:
+                scan.start()
+
+            diff = IncrementalDiff(quick_compare if self.compare_mode == 'quick' else None,
+                                   max_pending=self.max_pending_files, spill=self.create_manifest)
+            # 快速比较无法确定的文件，扫描结束后再比较哈希值
+            to_check = []
+            # 识别移动和复制时，只有一侧存在的文件等扫描结束后再配对；远程文件按哈希值记录，作为复制的来源
+            one_sided = []
+            remote_files = {}
+            running = len(scans)
+            while running:
+                try:
+                    side, kind, payload = results.get(timeout=0.2)
+                except queue.Empty:
+                    # 取消后不等待阻塞中的扫描，直接结束，断开连接让远程读取返回
+                    self.check_cancelled()
+                    continue
+
+                if kind == 'error':
+                    raise payload
+                if kind == 'done':
+                    running -= 1
+                    if side == 'local':
+                        diff.close_local()
+                    else:
+                        diff.close_remote()
+                    continue
+
+                if side == 'remote' and self.detect_moves and payload.digest:
+                    remote_files.setdefault(payload.digest, payload)
+                record = diff.add_local(payload) if side == 'local' else diff.add_remote(payload)
+                if record:
+                    change_count += self.collect_change(record, to_check, one_sided)
+
+            for record in diff.finish():
+                change_count += self.collect_change(record, to_check, one_sided)
+            for record in self.check_changes(to_check):
+                self.emit_change(*record)
+                change_count += 1
+            for record in self.find_moves(one_sided, remote_files):
+                self.emit_change(*record)
+                change_count += 1
+            self.log_emit(f'刷新完毕，共有 {change_count} 个文件需要处理')
+        except ScanCancelled:
+            self.log_emit('刷新已取消')
+        finally:
+            # 任意一侧出错时通知另一侧停止，断开连接让阻塞中的远程读取立即返回
+            self.cancel_event.set()
+            self.disconnect()
+            for scan in scans:
+                if scan.is_alive():
+                    scan.join()
+            if diff:
+                diff.close()
+        return change_count
+
+    def run(self):
+        """
+        按操作标志执行刷新或同步
+
+        :return: 刷新时为需要处理的文件数，同步时为同步失败的文件数
+        """
+        if self.flag == 'refresh':
+            return self.refresh_files()
+        elif self.flag == 'sync':
+            return self.sync_files()
@@ -0,0 +1,280 @@
+"""
+@File  : file_diff.py
+@Author: lyj
+@Create  : 2024/7/8 10:12
+@Modify  :
+@Description  : 本地和远程文件列表的差异比较
+"""
+import heapq
+from collections import namedtuple
+from operator import itemgetter
+
+# 文件列表中的一项，digest 为文件哈希值，快速比较模式下 size/mtime 为文件大小和修改时间（秒）
+FileEntry = namedtuple('FileEntry', ['path', 'relative_path', 'digest', 'size', 'mtime'], defaults=(None, None))
+
+_relative_path = itemgetter(1)
+
+
+def quick_compare(local_file, remote_file):
+    """
+    按文件大小和修改时间比较两个文件，修改时间精确到秒（SFTP和tar只保存整数秒）
+
+    :return: True 相同，False 不同，None 大小相同但修改时间不同，需要比较哈希值
+    """
+    if local_file.size != remote_file.size:
+        return False
+    if int(local_file.mtime) == int(remote_file.mtime):
+        return True
+    return None
+
+
+def compare_files(compare, local_file, remote_file):
+    """
+    比较两侧都有的同一个文件
+
+    :param compare: 比较函数，为 None 时比较哈希值
+    :return: 相同时为 None，不同时为 not_same，无法确定时为 check
+    """
+    same = compare(local_file, remote_file) if compare else local_file[2] == remote_file[2]
+    if same is None:
+        return 'check'
+    return None if same else 'not_same'
+
+
+def diff_files(local_files, remote_files):
+    """
+    比较本地和远程文件列表，按相对路径顺序依次产出差异记录。
+
+    两侧先按相对路径排序，再做一次归并扫描，整体复杂度 O(n log n)，
+    输出顺序只取决于相对路径，与文件列表的原始顺序无关。
+
+    :param local_files: 本地文件元组列表，(全路径, 相对路径, md5)
+    :param remote_files: 远程文件元组列表，(全路径, 相对路径, md5)
+    :return: 生成器，产出 (change, 相对路径, 本地文件元组, 远程文件元组)，
+             change 取值 not_same/local/remote，只有一侧存在时另一侧为 None
+    """
+    return diff_sorted(sorted(local_files, key=_relative_path), sorted(remote_files, key=_relative_path))
+
+
+def diff_sorted(local_files, remote_files, compare=None):
+    """
+    归并比较两个已经按相对路径排序的文件序列，两侧都只遍历一次，不保存已经比较过的文件，
+    可以直接比较 SortedManifest 这样不在内存中的清单。
+
+    :param local_files: 按相对路径排序的本地文件元组序列
+    :param remote_files: 按相对路径排序的远程文件元组序列
+    :param compare: 比较函数，见 IncrementalDiff，默认比较哈希值
+    :return: 生成器，产出的差异记录和 diff_files 一致，compare 无法确定时产出 change 为 check 的记录
+    """
+    local_iter = iter(local_files)
+    remote_iter = iter(remote_files)
+    local_file = next(local_iter, None)
+    remote_file = next(remote_iter, None)
+    while local_file is not None and remote_file is not None:
+        local_path = local_file[1]
+        remote_path = remote_file[1]
+        if local_path == remote_path:
+            # 本地和远程都有同名文件，然后比较两个文件的MD5值
+            change = compare_files(compare, local_file, remote_file)
+            if change:
+                yield change, local_path, local_file, remote_file
+            local_file = next(local_iter, None)
+            remote_file = next(remote_iter, None)
+        elif local_path < remote_path:
+            # 只有本地有此文件
+            yield 'local', local_path, local_file, None
+            local_file = next(local_iter, None)
+        else:
+            # 只有远程有此文件
+            yield 'remote', remote_path, None, remote_file
+            remote_file = next(remote_iter, None)
+
+    while local_file is not None:
+        yield 'local', local_file[1], local_file, None
+        local_file = next(local_iter, None)
+    while remote_file is not None:
+        yield 'remote', remote_file[1], None, remote_file
+        remote_file = next(remote_iter, None)
+
+
+class IncrementalDiff:
+    """
+    本地和远程文件陆续到达时的增量比较。
+
+    两侧都有的文件在第二次出现时立即得出结果；一侧声明完整（close_local/close_remote）后，
+    另一侧新到达的文件如果在对面找不到，也立即得出结果，不再保留在内存中。
+    其余只有一侧存在的文件在 finish() 中按相对路径顺序产出。
+
+    等待配对的文件超过 max_pending 个时（比如一侧扫描比另一侧快很多），两侧等待中的文件和之后加入的文件
+    都改为写入 spill 创建的有序清单，不再提前得出结果，finish() 时归并比较两个清单，内存占用不再随文件数增长。
+
+    产出的记录格式和 diff_files 一致：(change, 相对路径, 本地文件元组, 远程文件元组)。
+    指定 compare 时用它比较两侧都有的文件，compare 无法确定时产出 change 为 check 的记录，
+    由调用方计算哈希值后再比较。
+    """
+
+    def __init__(self, compare=None, max_pending=None, spill=None):
+        """
+        :param compare: 比较函数，参数为 (本地文件, 远程文件)，返回 True 相同 / False 不同 / None 无法确定，
+                        默认比较哈希值
+        :param max_pending: 内存中等待配对的文件数上限，为空时不限制
+        :param spill: 创建有序清单的函数，参数为 local/remote，返回的对象有 add/close 方法，迭代时按相对路径排序
+        """
+        self.compare = compare
+        self.max_pending = max_pending if spill else None
+        self.spill = spill
+        self.local_pending = {}
+        self.remote_pending = {}
+        self.local_closed = False
+        self.remote_closed = False
+        # 超过上限后两侧的有序清单
+        self.local_manifest = None
+        self.remote_manifest = None
+
+    def add_local(self, local_file):
+        """
+        加入一个本地文件
+
+        :param local_file: (全路径, 相对路径, md5)
+        :return: 能确定结果时返回差异记录，没有差异或暂时无法确定时返回 None
+        """
+        if self.local_manifest is not None:
+            self.local_manifest.add(local_file)
+            return None
+        relative_path = local_file[1]
+        remote_file = self.remote_pending.pop(relative_path, None)
+        if remote_file is not None:
+            return self._compare(relative_path, local_file, remote_file)
+        if self.remote_closed:
+            return 'local', relative_path, local_file, None
+        self.local_pending[relative_path] = local_file
+        self._check_pending()
+        return None
+
+    def add_remote(self, remote_file):
+        """
+        加入一个远程文件
+
+        :param remote_file: (全路径, 相对路径, md5)
+        :return: 能确定结果时返回差异记录，没有差异或暂时无法确定时返回 None
+        """
+        if self.remote_manifest is not None:
+            self.remote_manifest.add(remote_file)
+            return None
+        relative_path = remote_file[1]
+        local_file = self.local_pending.pop(relative_path, None)
+        if local_file is not None:
+            return self._compare(relative_path, local_file, remote_file)
+        if self.local_closed:
+            return 'remote', relative_path, None, remote_file
+        self.remote_pending[relative_path] = remote_file
+        self._check_pending()
+        return None
+
+    @property
+    def spilled(self):
+        """
+        是否已经改为写入有序清单
+        """
+        return self.local_manifest is not None
+
+    def _check_pending(self):
+        if self.max_pending is None or len(self.local_pending) + len(self.remote_pending) <= self.max_pending:
+            return
+        self.local_manifest = self.spill('local')
+        self.remote_manifest = self.spill('remote')
+        for local_file in self.local_pending.values():
+            self.local_manifest.add(local_file)
+        for remote_file in self.remote_pending.values():
+            self.remote_manifest.add(remote_file)
+        self.local_pending = {}
+        self.remote_pending = {}
+
+    def close_local(self):
+        """
+        本地文件已经全部加入
+        """
+        self.local_closed = True
+
+    def close_remote(self):
+        """
+        远程文件已经全部加入
+        """
+        self.remote_closed = True
+
+    def finish(self):
+        """
+        按相对路径顺序产出剩余的只有一侧存在的文件；
+        改为写入有序清单后，归并比较两个清单，也会产出 not_same/check 记录
+        """
+        if self.spilled:
+            yield from diff_sorted(self.local_manifest, self.remote_manifest, self.compare)
+            self.close()
+            return
+        local_records = (('local', path, self.local_pending[path], None)
+                         for path in sorted(self.local_pending))
+        remote_records = (('remote', path, None, self.remote_pending[path])
+                          for path in sorted(self.remote_pending))
+        yield from heapq.merge(local_records, remote_records, key=_relative_path)
+        self.local_pending = {}
+        self.remote_pending = {}
+
+    def close(self):
+        """
+        删除有序清单的临时文件
+        """
+        for manifest in (self.local_manifest, self.remote_manifest):
+            if manifest is not None:
+                manifest.close()
+
+    def _compare(self, relative_path, local_file, remote_file):
+        change = compare_files(self.compare, local_file, remote_file)
+        return (change, relative_path, local_file, remote_file) if change else None
+
+
+def detect_moves(records, remote_files, skip_digest=None):
+    """
+    按内容哈希把只有一侧存在的文件转换为远程服务器上的移动和复制。
+
+    只有本地有的文件和只有远程有的文件哈希值相同时，转换为一条 move 记录（远程移动），
+    对应的 remote 记录不再删除；剩余的本地文件如果在远程其他位置有相同内容，转换为 copy 记录（远程复制）。
+    同名的文件优先配对，其余按相对路径顺序配对。
+
+    :param records: 差异记录列表，(change, 相对路径, 本地文件元组, 远程文件元组)，只处理 local/remote 记录
+    :param remote_files: 远程文件哈希值 -> 远程文件元组，复制的来源，可以包括两侧都有的文件
+    :param skip_digest: 不参与配对的哈希值，比如空文件的哈希值
+    :return: 按相对路径排序的差异记录列表，move/copy 记录的远程文件元组为源文件
+    """
+    results = []
+    local_records = []
+    # 哈希值 -> 只有远程有的文件列表
+    removed = {}
+    for record in records:
+        change, relative_path, local_file, remote_file = record
+        if change == 'local' and local_file[2] and local_file[2] != skip_digest:
+            local_records.append(record)
+        elif change == 'remote' and remote_file[2] and remote_file[2] != skip_digest:
+            removed.setdefault(remote_file[2], []).append(remote_file)
+        else:
+            results.append(record)
+
+    for candidates in removed.values():
+        candidates.sort(key=_relative_path, reverse=True)
+
+    for change, relative_path, local_file, _ in sorted(local_records, key=_relative_path):
+        digest = local_file[2]
+        candidates = removed.get(digest)
+        if candidates:
+            name = relative_path.rpartition('/')[2]
+            index = next((i for i, remote_file in enumerate(candidates)
+                          if remote_file[1].rpartition('/')[2] == name), len(candidates) - 1)
+            results.append(('move', relative_path, local_file, candidates.pop(index)))
+        elif digest in remote_files:
+            results.append(('copy', relative_path, local_file, remote_files[digest]))
+        else:
+            results.append((change, relative_path, local_file, None))
+
+    for candidates in removed.values():
+        results.extend(('remote', remote_file[1], None, remote_file) for remote_file in candidates)
+    results.sort(key=_relative_path)
+    return results
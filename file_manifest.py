@@ -0,0 +1,145 @@
+"""
+@File  : file_manifest.py
+@Author: lyj
+@Create  : 2024/8/2 10:30
+@Modify  :
+@Description  : 按相对路径排序、保存在临时文件中的紧凑文件清单
+
+文件数量很多时，内存中只保留不超过 run_size 条记录，攒满后排序写入一个临时文件（有序段），
+读取时多路归并所有有序段，按相对路径顺序逐条产出，内存占用和文件总数无关。
+每条记录只保存相对路径、二进制哈希值、文件大小和修改时间，全路径在读取时由根目录拼接。
+"""
+import heapq
+import posixpath
+import struct
+import tempfile
+from operator import itemgetter
+
+from file_diff import FileEntry
+
+# 内存中最多保留的记录数，超过后写入一个有序段
+DEFAULT_RUN_SIZE = 100_000
+# 有序段临时文件的读写缓冲大小
+RUN_BUFFER_SIZE = 64 * 1024
+
+# 记录头：相对路径字节数、哈希值字节数、标志位、文件大小、修改时间
+_HEADER = struct.Struct('<IBBqd')
+# 哈希值以二进制保存（十六进制字符串解码），否则保存原始字符串
+_FLAG_BINARY = 1
+_FLAG_DIGEST = 2
+_FLAG_STAT = 4
+
+_relative_path = itemgetter(0)
+
+
+def _encode(record):
+    relative_path, digest, size, mtime = record
+    flags = 0
+    digest_bytes = b''
+    if digest is not None:
+        flags |= _FLAG_DIGEST
+        try:
+            digest_bytes = bytes.fromhex(digest)
+        except ValueError:
+            digest_bytes = None
+        if digest_bytes is not None and digest_bytes.hex() == digest:
+            flags |= _FLAG_BINARY
+        else:
+            digest_bytes = digest.encode()
+    if size is not None:
+        flags |= _FLAG_STAT
+    else:
+        size, mtime = 0, 0.0
+    path_bytes = relative_path.encode('utf-8', 'surrogateescape')
+    return _HEADER.pack(len(path_bytes), len(digest_bytes), flags, size, mtime) + path_bytes + digest_bytes
+
+
+def _read_run(run):
+    """
+    逐条读取一个有序段
+
+    :return: 生成器，产出 (相对路径, 哈希值, 文件大小, 修改时间)
+    """
+    run.seek(0)
+    read = run.read
+    while True:
+        header = read(_HEADER.size)
+        if not header:
+            return
+        path_length, digest_length, flags, size, mtime = _HEADER.unpack(header)
+        relative_path = read(path_length).decode('utf-8', 'surrogateescape')
+        digest = None
+        if flags & _FLAG_DIGEST:
+            digest_bytes = read(digest_length)
+            digest = digest_bytes.hex() if flags & _FLAG_BINARY else digest_bytes.decode()
+        if not flags & _FLAG_STAT:
+            size = mtime = None
+        yield relative_path, digest, size, mtime
+
+
+class SortedManifest:
+    """
+    按相对路径排序的文件清单，记录超过 run_size 条时写入临时文件。
+
+    add 加入 FileEntry，加入完成后迭代得到按相对路径排序的 FileEntry，可以重复迭代，用完后调用 close。
+    """
+
+    def __init__(self, root, join=posixpath.join, run_size=DEFAULT_RUN_SIZE, directory=None):
+        """
+        :param root: 文件夹的路径，读取时和相对路径拼接成全路径
+        :param join: 拼接路径的函数，本地文件夹使用 os.path.join
+        :param run_size: 内存中最多保留的记录数
+        :param directory: 临时文件所在的目录，默认为系统临时目录
+        """
+        self.root = root
+        # 全路径的前缀，拼接时不再逐个调用 join
+        self.prefix = join(root, '')
+        self.run_size = run_size
+        self.directory = directory
+        self.buffer = []
+        self.runs = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, entry):
+        """
+        加入一个文件
+
+        :param entry: FileEntry
+        """
+        self.buffer.append((entry.relative_path, entry.digest, entry.size, entry.mtime))
+        self.count += 1
+        if len(self.buffer) >= self.run_size:
+            self.write_run()
+
+    def write_run(self):
+        """
+        内存中的记录排序后写入一个新的有序段
+        """
+        self.buffer.sort(key=_relative_path)
+        run = tempfile.TemporaryFile(buffering=RUN_BUFFER_SIZE, prefix='filesync-', dir=self.directory)
+        for start in range(0, len(self.buffer), 1000):
+            run.write(b''.join(map(_encode, self.buffer[start:start + 1000])))
+        run.flush()
+        self.runs.append(run)
+        self.buffer = []
+
+    def __iter__(self):
+        self.buffer.sort(key=_relative_path)
+        streams = [_read_run(run) for run in self.runs]
+        streams.append(iter(self.buffer))
+        prefix = self.prefix
+        # 同一侧的相对路径不会重复，元组比较只比较第一项，不需要 key 函数
+        for relative_path, digest, size, mtime in heapq.merge(*streams):
+            yield FileEntry(prefix + relative_path, relative_path, digest, size, mtime)
+
+    def close(self):
+        """
+        删除临时文件
+        """
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        self.buffer = []
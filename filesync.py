@@ -0,0 +1,170 @@
+"""
+@File  : filesync.py
+@Author: lyj
+@Create  : 2024/7/23 10:15
+@Modify  :
+@Description  : 命令行入口，不加载界面，可以在 CI 或定时任务中刷新/同步
+
+用法:
+    python filesync.py refresh --server 服务器名称 [--json]
+    python filesync.py sync --server 服务器名称 [--json]
+    python filesync.py daemon --server 服务器名称 --interval 60
+    python filesync.py watch --server 服务器名称 [--auto-sync] [--debounce 1]
+
+--json 时每条结果以一行 JSON 输出到标准输出，日志输出到标准错误。
+yaml 和比较模块在解析完参数后才导入，paramiko 在连接服务器时才导入。
+"""
+import argparse
+import json
+import sys
+import time
+from datetime import datetime
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='filesync', description='比较并同步本地文件夹和远程文件夹')
+    parser.add_argument('command', choices=['refresh', 'sync', 'daemon', 'watch'],
+                        help='refresh 只比较，sync 比较后同步，daemon 定时比较并同步，watch 监听本地文件变化后比较')
+    parser.add_argument('--server', action='append', required=True, help='config.yaml 中的服务器名称，可以指定多个')
+    parser.add_argument('--config', default='config.yaml', help='配置文件路径，默认为 config.yaml')
+    parser.add_argument('--json', action='store_true', help='以 JSON Lines 格式输出结果')
+    parser.add_argument('--rehash', action='store_true', help='忽略本地哈希缓存，重新计算所有文件')
+    parser.add_argument('--interval', type=float, default=60, help='daemon 模式两次同步的间隔（秒），默认 60')
+    parser.add_argument('--auto-sync', action='store_true', help='watch 模式比较后自动同步')
+    parser.add_argument('--debounce', type=float, default=1.0, help='watch 模式最后一次文件变化后等待的秒数，默认 1')
+    return parser.parse_args(argv)
+
+
+class Printer:
+    """
+    输出日志和结果，--json 时结果为 JSON Lines，日志输出到标准错误
+    """
+
+    def __init__(self, as_json):
+        self.as_json = as_json
+
+    def log(self, message):
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f'[{timestamp}] {message}', file=sys.stderr if self.as_json else sys.stdout, flush=True)
+
+    def data(self, data):
+        if self.as_json:
+            print(json.dumps(data, ensure_ascii=False), flush=True)
+        elif data['type'] == 'refresh' and data.get('source_path'):
+            print(f"{data['server']}\t{data['change']}\t{data['path']}\t<- {data['source_path']}", flush=True)
+        elif data['type'] == 'refresh':
+            print(f"{data['server']}\t{data['change']}\t{data['path']}", flush=True)
+        else:
+            print(f"{data['server']}\t{'ok' if data['status'] else 'failed'}\t{data['path']}", flush=True)
+
+    def summary(self, server_name, command, count):
+        if self.as_json:
+            key = 'changes' if command == 'refresh' else 'failed'
+            print(json.dumps({'type': 'summary', 'server': server_name, 'command': command, key: count},
+                             ensure_ascii=False), flush=True)
+
+
+def run_server(server, command, printer, force_rehash=False):
+    """
+    刷新一个服务器，sync 时接着同步刷新出的文件
+
+    :return: 是否全部成功
+    """
+    from file_comparator import FolderComparator, comparator_options
+
+    changed_files = []
+
+    def on_data(data):
+        changed_files.append(data)
+        printer.data(data)
+
+    options = comparator_options(server)
+    comparator = FolderComparator(server_name=server["name"], flag='refresh', changed_files=None,
+                                  force_rehash=force_rehash, on_log=printer.log, on_data=on_data, **options)
+    change_count = comparator.refresh_files()
+    printer.summary(server["name"], 'refresh', change_count)
+    if command == 'refresh' or not changed_files:
+        return True
+
+    comparator = FolderComparator(server_name=server["name"], flag='sync', changed_files=changed_files,
+                                  on_log=printer.log, on_data=printer.data, **options)
+    fail_count = comparator.sync_files()
+    printer.summary(server["name"], 'sync', fail_count)
+    return not fail_count
+
+
+def watch_servers(servers, args, printer):
+    """
+    监听本地文件变化，每个服务器一个线程，Ctrl+C 退出
+    """
+    import threading
+
+    from file_comparator import comparator_options
+    from local_watcher import WatchSession
+
+    sessions = []
+    threads = []
+    for server in servers:
+        session = WatchSession(server["name"], comparator_options(server), on_log=printer.log, on_data=printer.data,
+                               debounce=args.debounce, auto_sync=args.auto_sync)
+        thread = threading.Thread(target=session.run, daemon=True)
+        thread.start()
+        sessions.append(session)
+        threads.append(thread)
+
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        for session in sessions:
+            session.stop()
+        for thread in threads:
+            thread.join()
+        return 0
+    return 1
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    printer = Printer(args.json)
+
+    import yaml
+
+    try:
+        with open(args.config, "r", encoding='utf-8') as file:
+            config = yaml.safe_load(file)
+    except FileNotFoundError:
+        printer.log(f"配置文件 {args.config} 未找到，请先设置连接信息。")
+        return 2
+
+    servers = {server["name"]: server for server in config.get("servers") or []}
+    missing = [name for name in args.server if name not in servers]
+    if missing:
+        printer.log(f"服务器 {', '.join(missing)} 未找到，请先设置连接信息。")
+        return 2
+
+    if args.command == 'watch':
+        return watch_servers([servers[name] for name in args.server], args, printer)
+
+    command = 'sync' if args.command == 'daemon' else args.command
+    while True:
+        success = True
+        for name in args.server:
+            try:
+                success = run_server(servers[name], command, printer, args.rehash) and success
+            except Exception as e:
+                printer.log(f"{name}, 处理失败: {e}")
+                success = False
+        if args.command != 'daemon':
+            return 0 if success else 1
+        try:
+            time.sleep(args.interval)
+        except KeyboardInterrupt:
+            return 0
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        sys.exit(130)
@@ -0,0 +1,87 @@
+"""
+@File  : hash_algorithms.py
+@Author: lyj
+@Create  : 2024/7/31 09:50
+@Modify  :
+@Description  : 比较文件使用的哈希算法，本地用 Python 计算，远程用对应的命令计算
+
+hash_algorithm 为 auto 时探测远程有哪些命令，按速度从快到慢选择两侧都支持的第一个算法。
+xxHash 本地需要安装 xxhash 包，远程需要 xxhsum 0.8 以上版本。
+"""
+import hashlib
+import shlex
+from collections import namedtuple
+
+# name: 算法名称；command: 远程计算的命令，输出格式和 md5sum 一致；
+# factory: 本地创建哈希对象的函数；builtin: 远程 python3 的 hashlib 是否支持
+HashAlgorithm = namedtuple('HashAlgorithm', ['name', 'command', 'factory', 'builtin'])
+
+
+def _xxhash(name):
+    def factory():
+        import xxhash
+        return getattr(xxhash, name)()
+    return factory
+
+
+ALGORITHMS = {algorithm.name: algorithm for algorithm in (
+    HashAlgorithm('xxh128', 'xxhsum -H2', _xxhash('xxh3_128'), False),
+    HashAlgorithm('xxh64', 'xxhsum -H1', _xxhash('xxh64'), False),
+    HashAlgorithm('blake2b', 'b2sum', hashlib.blake2b, True),
+    HashAlgorithm('md5', 'md5sum', hashlib.md5, True),
+    HashAlgorithm('sha1', 'sha1sum', hashlib.sha1, True),
+    HashAlgorithm('sha256', 'sha256sum', hashlib.sha256, True),
+)}
+
+# auto 时的选择顺序，越靠前越快
+PREFERENCE = tuple(ALGORITHMS)
+AUTO = 'auto'
+DEFAULT_ALGORITHM = 'md5'
+
+
+def get_algorithm(name):
+    """
+    :param name: 算法名称
+    :return: HashAlgorithm，名称不支持时抛出 ValueError
+    """
+    try:
+        return ALGORITHMS[name]
+    except KeyError:
+        raise ValueError(f'不支持的哈希算法: {name}，可选: {AUTO}, {", ".join(ALGORITHMS)}') from None
+
+
+def local_available(algorithm):
+    """
+    本地是否可以计算这个算法
+    """
+    try:
+        algorithm.factory()
+    except (ImportError, ValueError):
+        return False
+    return True
+
+
+def probe_command():
+    """
+    探测远程有哪些哈希命令的shell命令，每行输出一个存在的命令名
+    """
+    names = ' '.join(shlex.quote(name) for name in dict.fromkeys(
+        algorithm.command.split()[0] for algorithm in ALGORITHMS.values()))
+    return f'for c in {names}; do command -v "$c" >/dev/null 2>&1 && echo "$c"; done'
+
+
+def choose_algorithm(remote_commands, builtin_only=False):
+    """
+    按 PREFERENCE 选择本地和远程都支持的最快的算法
+
+    :param remote_commands: 远程存在的命令名集合
+    :param builtin_only: 只选择远程 python3 hashlib 支持的算法（远程清单由 python3 计算）
+    :return: HashAlgorithm
+    """
+    for name in PREFERENCE:
+        algorithm = ALGORITHMS[name]
+        if builtin_only and not algorithm.builtin:
+            continue
+        if algorithm.command.split()[0] in remote_commands and local_available(algorithm):
+            return algorithm
+    return ALGORITHMS[DEFAULT_ALGORITHM]
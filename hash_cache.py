@@ -0,0 +1,148 @@
+"""
+@File  : hash_cache.py
+@Author: lyj
+@Create  : 2024/7/9 09:41
+@Modify  :
+@Description  : 本地文件哈希缓存，按 (大小, 修改时间, inode) 判断文件是否变化，每条记录保存计算它的哈希算法
+"""
+import os
+import re
+import sqlite3
+import time
+
+CACHE_FOLDER = '.filesync_cache'
+
+# 修改时间距离扫描开始不足这个时长的文件不写入缓存，
+# 防止同一时间精度内文件再次被修改，而缓存里的签名没有变化
+RACY_WINDOW_NS = 2_000_000_000
+# 批量查找和写入缓存时每批的记录数，不超过SQLite一条语句的参数个数上限
+BATCH_SIZE = 500
+
+
+def get_cache_path(server_name):
+    """
+    获取服务器对应的缓存文件路径，每个服务器配置一个缓存文件
+    """
+    file_name = re.sub(r'[^\w.-]', '_', server_name) or 'default'
+    return os.path.join(CACHE_FOLDER, f'{file_name}.sqlite3')
+
+
+class HashCache:
+    """
+    基于SQLite的本地文件哈希缓存。
+
+    缓存不读入内存，扫描过程中按批查找，新记录攒够一批写入数据库（事务在 save() 时才提交）。
+    本次扫描中出现过的文件记录在临时表中，save() 时用SQL删除没有出现的过期记录。
+    内存占用和文件总数无关；没有调用 save() 就关闭时，本次的修改全部丢弃。
+    """
+
+    def __init__(self, db_path, local_folder, algorithm='md5'):
+        """
+        :param db_path: 缓存文件路径
+        :param local_folder: 缓存对应的本地文件夹，和缓存中记录的不一致时清空缓存
+        :param algorithm: 哈希算法名称，其他算法计算的记录不使用
+        """
+        folder = os.path.dirname(db_path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        self.algorithm = algorithm
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(files)')]
+        if columns and 'algorithm' not in columns:
+            # 旧版本的缓存没有记录算法，直接丢弃
+            self.conn.execute('DROP TABLE files')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+                          'inode INTEGER, digest TEXT, algorithm TEXT)')
+
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'local_folder'").fetchone()
+        if row is None or row[0] != local_folder:
+            self.conn.execute('DELETE FROM files')
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('local_folder', ?)", (local_folder,))
+        self.conn.commit()
+
+        # 本次扫描中出现过的文件，临时表超出SQLite的缓存后写入临时文件
+        self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS seen (path TEXT PRIMARY KEY)')
+        # 等待写入数据库的记录
+        self.seen = []
+        self.changed = []
+        self.scan_start_ns = time.time_ns()
+
+    def clear(self):
+        """
+        清空缓存，用于强制重新计算所有文件的哈希值
+        """
+        self.changed.clear()
+        with self.conn:
+            self.conn.execute('DELETE FROM files')
+
+    def lookup_many(self, files):
+        """
+        批量查找文件的哈希值。
+
+        :param files: (相对路径, os.stat 结果) 列表
+        :return: 和 files 顺序一致的列表，签名没有变化时为缓存的哈希值，否则为 None
+        """
+        paths = [relative_path for relative_path, _ in files]
+        self.mark_seen(paths)
+        cached = {}
+        for start in range(0, len(paths), BATCH_SIZE):
+            batch = paths[start:start + BATCH_SIZE]
+            cached.update((path, entry) for path, *entry in self.conn.execute(
+                f'SELECT path, size, mtime_ns, inode, digest FROM files '
+                f'WHERE algorithm = ? AND path IN ({", ".join("?" * len(batch))})', [self.algorithm, *batch]))
+
+        digests = []
+        for relative_path, stat_result in files:
+            entry = cached.get(relative_path)
+            if entry and tuple(entry[:3]) == (stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino):
+                digests.append(entry[3])
+            else:
+                digests.append(None)
+        return digests
+
+    def mark_seen(self, paths):
+        """
+        记录本次扫描中出现的文件，攒够一批写入临时表
+        """
+        self.seen.extend(paths)
+        if len(self.seen) >= BATCH_SIZE:
+            self.flush()
+
+    def update(self, relative_path, stat_result, digest):
+        """
+        记录文件新的哈希值
+        """
+        self.seen.append(relative_path)
+        if stat_result.st_mtime_ns < self.scan_start_ns - RACY_WINDOW_NS:
+            self.changed.append((relative_path, stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino,
+                                 digest, self.algorithm))
+        if len(self.seen) >= BATCH_SIZE or len(self.changed) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """
+        把攒下的记录写入数据库，不提交事务
+        """
+        if self.seen:
+            self.conn.executemany('INSERT OR IGNORE INTO seen VALUES (?)', [(path,) for path in self.seen])
+            self.seen = []
+        if self.changed:
+            self.conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)', self.changed)
+            self.changed = []
+
+    def save(self, prune=True):
+        """
+        提交新记录，并删除本次扫描中没有出现的过期记录
+
+        :param prune: 是否删除过期记录，只查找了部分文件时为 False
+        """
+        self.flush()
+        with self.conn:
+            if prune:
+                self.conn.execute('DELETE FROM files WHERE path NOT IN (SELECT path FROM seen)')
+            self.conn.execute('DELETE FROM seen')
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,140 @@
+"""
+@File  : ignore_rules.py
+@Author: lyj
+@Create  : 2024/7/25 14:00
+@Modify  :
+@Description  : 忽略规则，ignore_folders/ignore_file_types 只编译一次，本地遍历和远程 find 使用同一套规则
+
+ignore_folders 的写法和 .gitignore 中的文件夹规则类似:
+    static            只匹配根目录下的 static 文件夹
+    static/images     只匹配根目录下的 static/images 文件夹
+    **/__pycache__    匹配任意层级的 __pycache__ 文件夹
+    a/**/b            匹配 a 下面任意层级的 b 文件夹
+每一级都可以使用 * ? [abc] 通配符，* 不匹配路径分隔符。
+被忽略的文件夹中的所有内容都被忽略，遍历时整个子树直接跳过。
+"""
+import re
+import shlex
+
+_GLOB_PATTERN = re.compile(r'\*|\?|\[[^/\]]*\]')
+
+
+def _translate_segment(segment):
+    """
+    把一级文件夹名中的通配符转换为正则表达式
+    """
+    pattern = ''
+    position = 0
+    for match in _GLOB_PATTERN.finditer(segment):
+        pattern += re.escape(segment[position:match.start()])
+        token = match.group(0)
+        if token == '*':
+            pattern += '[^/]*'
+        elif token == '?':
+            pattern += '[^/]'
+        else:
+            body = token[1:-1]
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            pattern += f'[{body}]'
+        position = match.end()
+    return pattern + re.escape(segment[position:])
+
+
+def _translate_rule(rule):
+    """
+    把一条文件夹规则转换为正则表达式，匹配这个文件夹以及它下面的所有路径
+    """
+    rule = rule.replace('\\', '/').strip('/')
+    if rule.startswith('**/'):
+        prefix = '(?:.*/)?'
+        rule = rule[3:]
+    else:
+        prefix = ''
+    parts = []
+    for segment in rule.split('/'):
+        if segment == '**':
+            parts.append('(?:.*/)?')
+        else:
+            parts.append(_translate_segment(segment) + '/')
+    return prefix + ''.join(parts)[:-1] + '(?:/|$)'
+
+
+class IgnoreRules:
+    """
+    编译后的忽略规则，路径都是相对于同步根目录、以 / 分隔的相对路径
+    """
+
+    def __init__(self, ignore_folders=None, ignore_file_types=None):
+        """
+        :param ignore_folders: 需要忽略的文件夹规则
+        :param ignore_file_types: 需要忽略的文件类型后缀
+        """
+        self.folders = [rule.replace('\\', '/').strip('/') for rule in ignore_folders or [] if rule.strip('/')]
+        self.suffixes = tuple(f'.{file_type}' for file_type in ignore_file_types or [])
+        self._folder_pattern = None
+        if self.folders:
+            self._folder_pattern = re.compile('^(?:' + '|'.join(_translate_rule(rule) for rule in self.folders) + ')')
+
+    def ignore_dir(self, relative_path):
+        """
+        文件夹（或它的上级文件夹）是否被忽略
+
+        :param relative_path: 文件夹的相对路径，根目录为空字符串
+        """
+        return bool(relative_path and self._folder_pattern and self._folder_pattern.match(relative_path))
+
+    def ignore_file(self, name):
+        """
+        文件类型是否被忽略
+
+        :param name: 文件名或文件路径
+        """
+        return bool(self.suffixes) and name.endswith(self.suffixes)
+
+    def ignore_path(self, relative_path):
+        """
+        文件是否被忽略，文件类型被忽略或者在被忽略的文件夹中
+
+        :param relative_path: 文件的相对路径
+        """
+        return self.ignore_file(relative_path) or self.ignore_dir(relative_path.rpartition('/')[0])
+
+    def prune_dirs(self, relative_root, dirnames):
+        """
+        os.walk 中原地删除被忽略的子文件夹，被忽略的子树不会被遍历
+
+        :param relative_root: 当前文件夹的相对路径，根目录为空字符串
+        :param dirnames: os.walk 返回的子文件夹名列表
+        """
+        if not self._folder_pattern:
+            return
+        prefix = f'{relative_root}/' if relative_root else ''
+        dirnames[:] = [name for name in dirnames if not self._folder_pattern.match(prefix + name)]
+
+    def find_expression(self, root):
+        """
+        生成 find 的表达式，被忽略的文件夹使用 -prune 跳过，被忽略的文件类型排除，
+        后面需要接着写文件的条件和输出动作。
+
+        find -path 的 * 可以匹配 /，带通配符的规则在远程可能多匹配少量路径，不带通配符的规则两侧完全一致。
+
+        :param root: 远程文件夹的路径
+        :return: 如 "-type d ( -path 'root/static' -o -path '*/__pycache__' ) -prune -o -type f ! -name '*.pyc'"
+        """
+        root = root.rstrip('/')
+        expression = ''
+        if self.folders:
+            paths = []
+            for rule in self.folders:
+                path = f'*/{rule[3:]}' if rule.startswith('**/') else f'{root}/{rule}'
+                if '/**/' in path:
+                    # a/**/b 同时匹配 a/b 和 a/.../b
+                    paths.append(f'-path {shlex.quote(path.replace("/**/", "/"))}')
+                    path = path.replace('/**/', '/*/')
+                paths.append(f'-path {shlex.quote(path)}')
+            expression = f"-type d \\( {' -o '.join(paths)} \\) -prune -o "
+        expression += '-type f'
+        for suffix in self.suffixes:
+            expression += f' ! -name {shlex.quote(f"*{suffix}")}'
+        return expression
@@ -0,0 +1,377 @@
+"""
+@File  : local_watcher.py
+@Author: lyj
+@Create  : 2024/7/24 09:20
+@Modify  :
+@Description  : 监听本地文件夹的变化（Linux inotify），只比较变化的文件
+
+第一次全量比较后记住本地和远程的文件状态，之后只对 inotify 报告变化的文件重新计算哈希，
+和记住的远程状态比较。inotify 事件队列溢出时重新全量比较。
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+from file_comparator import FolderComparator
+from file_diff import FileEntry, diff_files
+from ignore_rules import IgnoreRules
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+              | IN_ONLYDIR)
+
+_EVENT = struct.Struct('iIII')
+# 一次读取事件的缓冲大小
+EVENT_BUFFER_SIZE = 64 * 1024
+# 默认的防抖时间（秒），最后一个事件之后等待这么久再比较
+DEFAULT_DEBOUNCE = 1.0
+
+
+class InotifyWatcher:
+    """
+    递归监听一个文件夹，记录变化的文件和文件夹（相对路径）。
+
+    新建的子文件夹自动加入监听；被忽略的文件夹不监听，被忽略的文件不记录。
+    """
+
+    def __init__(self, folder, ignore_rules=None):
+        """
+        :param folder: 监听的文件夹
+        :param ignore_rules: 忽略规则，IgnoreRules
+        """
+        if not sys.platform.startswith('linux'):
+            raise OSError('监听模式只支持 Linux')
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.folder = folder
+        self.ignore_rules = ignore_rules or IgnoreRules()
+        self.watches = {}
+        self.dirty_files = set()
+        self.dirty_dirs = set()
+        self.overflowed = False
+        self.last_event = 0.0
+        self.lock = threading.Lock()
+        self.changed = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f'{os.strerror(error)}: {path}')
+        self.watches[wd] = path
+
+    def add_tree(self, folder):
+        """
+        监听文件夹和所有没有被忽略的子文件夹
+        """
+        for root, dirs, _ in os.walk(folder):
+            self.ignore_rules.prune_dirs(self.relative(root), dirs)
+            try:
+                self.add_watch(root)
+            except FileNotFoundError:
+                dirs[:] = []
+
+    def start(self):
+        self.add_tree(self.folder)
+        self.thread = threading.Thread(target=self.read_events, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        os.close(self.fd)
+
+    def relative(self, path):
+        relative_path = os.path.relpath(path, self.folder).replace('\\', '/')
+        return '' if relative_path == '.' else relative_path
+
+    def read_events(self):
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        while not self.stopped.is_set():
+            if not poller.poll(200):
+                continue
+            try:
+                buffer = os.read(self.fd, EVENT_BUFFER_SIZE)
+            except BlockingIOError:
+                continue
+            offset = 0
+            with self.lock:
+                while offset < len(buffer):
+                    wd, mask, _, length = _EVENT.unpack_from(buffer, offset)
+                    offset += _EVENT.size
+                    name = os.fsdecode(buffer[offset:offset + length].rstrip(b'\0'))
+                    offset += length
+                    self.handle_event(wd, mask, name)
+                self.last_event = time.monotonic()
+            self.changed.set()
+
+    def handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self.overflowed = True
+            return
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+        directory = self.watches.get(wd)
+        if directory is None or not name:
+            return
+
+        path = os.path.join(directory, name)
+        relative_path = self.relative(path)
+        if mask & IN_ISDIR:
+            if self.ignore_rules.ignore_dir(relative_path):
+                return
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(path)
+            self.dirty_dirs.add(relative_path)
+        elif not self.ignore_rules.ignore_path(relative_path):
+            self.dirty_files.add(relative_path)
+
+    def wait(self, timeout=None):
+        """
+        等待新的事件
+
+        :return: 是否有新的事件
+        """
+        result = self.changed.wait(timeout)
+        self.changed.clear()
+        return result
+
+    def quiet_for(self):
+        """
+        距离最后一个事件的秒数
+        """
+        with self.lock:
+            return time.monotonic() - self.last_event
+
+    def take_dirty(self):
+        """
+        取出并清空变化的文件和文件夹
+
+        :return: (文件相对路径集合, 文件夹相对路径集合, 事件队列是否溢出)
+        """
+        with self.lock:
+            files, dirs, overflowed = self.dirty_files, self.dirty_dirs, self.overflowed
+            self.dirty_files, self.dirty_dirs, self.overflowed = set(), set(), False
+        return files, dirs, overflowed
+
+
+class WatchSession:
+    """
+    监听模式：全量比较一次，之后只比较变化的文件，可选在防抖时间后自动同步
+    """
+
+    def __init__(self, server_name, options, on_log=None, on_data=None, debounce=DEFAULT_DEBOUNCE,
+                 auto_sync=False):
+        """
+        :param server_name: 服务器名称
+        :param options: comparator_options 生成的参数
+        :param on_log: 日志回调
+        :param on_data: 结果回调
+        :param debounce: 最后一个事件之后等待的秒数
+        :param auto_sync: 比较后是否自动同步
+        """
+        # 只比较变化的文件时需要本地和远程的哈希值，这里固定使用哈希比较
+        self.options = dict(options, compare_mode='hash')
+        self.server_name = server_name
+        self.on_log = on_log
+        self.on_data = on_data
+        self.debounce = debounce
+        self.auto_sync = auto_sync
+        self.local_state = {}
+        self.remote_state = {}
+        self.watcher = None
+        self.stopped = threading.Event()
+
+    def create_comparator(self, flag, changed_files=None, on_data=None):
+        return FolderComparator(server_name=self.server_name, flag=flag, changed_files=changed_files,
+                                on_log=self.on_log, on_data=on_data or self.on_data, **self.options)
+
+    def full_refresh(self):
+        """
+        全量比较，记住本地和远程的文件状态
+
+        :return: 不一致的文件记录
+        """
+        records = []
+        comparator = self.create_comparator('refresh', on_data=lambda data: records.append(data))
+        comparator.connect()
+        try:
+            # 之后只比较变化的文件时不再连接服务器，固定使用这次确定的哈希算法
+            self.options['hash_algorithm'] = comparator.resolve_hash_algorithm().name
+            local_files = comparator.get_all_files(comparator.local_folder)
+            remote_files = comparator.get_all_remote_files(comparator.remote_folder)
+        finally:
+            comparator.disconnect()
+        self.local_state = {file.relative_path: file for file in local_files}
+        self.remote_state = {file.relative_path: file for file in remote_files}
+        self.emit_changes(comparator, list(diff_files(local_files, remote_files)))
+        return self.emit_records(records)
+
+    def emit_changes(self, comparator, changes):
+        """
+        发送差异记录，开启 detect_moves 时先按哈希值把只有一侧存在的文件转换为远程移动和复制
+
+        :param comparator: 发送记录的 FolderComparator
+        :param changes: 差异记录列表
+        """
+        one_sided = [change for change in changes if change[0] in ('local', 'remote')]
+        if comparator.detect_moves and one_sided:
+            remote_files = {}
+            for remote_file in self.remote_state.values():
+                remote_files.setdefault(remote_file.digest, remote_file)
+            changes = [change for change in changes if change[0] not in ('local', 'remote')]
+            changes += comparator.find_moves(one_sided, remote_files)
+        for change in changes:
+            comparator.emit_change(*change)
+
+    def emit_records(self, records):
+        if self.on_data:
+            for data in records:
+                self.on_data(data)
+        self.log(f'刷新完毕，共有 {len(records)} 个文件需要处理')
+        return records
+
+    def log(self, msg):
+        if self.on_log:
+            self.on_log(f'{self.server_name}, {msg}')
+
+    def expand_dirs(self, files, dirs):
+        """
+        文件夹变化时，文件夹中已知的文件和现在的文件都需要重新比较
+        """
+        local_folder = self.options['local_folder']
+        for directory in dirs:
+            prefix = directory + '/'
+            for state in (self.local_state, self.remote_state):
+                files.update(path for path in state if path.startswith(prefix))
+            for root, _, names in os.walk(os.path.join(local_folder, directory)):
+                for name in names:
+                    files.add(os.path.relpath(os.path.join(root, name), local_folder).replace('\\', '/'))
+        return files
+
+    def refresh_dirty(self, files, dirs):
+        """
+        只比较变化的文件
+
+        :return: 不一致的文件记录
+        """
+        records = []
+        changes = []
+        comparator = self.create_comparator('refresh', on_data=lambda data: records.append(data))
+        local_folder = self.options['local_folder']
+        for relative_path in sorted(self.expand_dirs(files, dirs)):
+            full_path = os.path.join(local_folder, relative_path)
+            local_file = None
+            if os.path.isfile(full_path) and not comparator.ignore_rules.ignore_path(relative_path):
+                try:
+                    local_file = FileEntry(full_path, relative_path, comparator.get_digest(full_path))
+                except OSError:
+                    pass
+            if local_file:
+                self.local_state[relative_path] = local_file
+            else:
+                self.local_state.pop(relative_path, None)
+
+            remote_file = self.remote_state.get(relative_path)
+            if local_file and remote_file:
+                if local_file.digest != remote_file.digest:
+                    changes.append(('not_same', relative_path, local_file, remote_file))
+            elif local_file:
+                changes.append(('local', relative_path, local_file, None))
+            elif remote_file:
+                changes.append(('remote', relative_path, None, remote_file))
+        self.emit_changes(comparator, changes)
+        return self.emit_records(records)
+
+    def sync(self, records):
+        """
+        同步不一致的文件，成功的文件更新记住的远程状态
+
+        :return: 同步失败的文件数
+        """
+        results = []
+
+        def on_data(data):
+            results.append(data)
+            if self.on_data:
+                self.on_data(data)
+
+        moved = {record['path']: record['source_path'] for record in records if record['change'] == 'move'}
+        comparator = self.create_comparator('sync', changed_files=records, on_data=on_data)
+        fail_count = comparator.sync_files()
+        for data in results:
+            if not data['status']:
+                continue
+            if data['path'] in moved:
+                # 移动后远程的源文件已经不存在
+                self.remote_state.pop(moved[data['path']], None)
+            local_file = self.local_state.get(data['path'])
+            if local_file:
+                self.remote_state[data['path']] = local_file._replace(
+                    path=f"{self.options['remote_folder'].rstrip('/')}/{data['path']}")
+            else:
+                self.remote_state.pop(data['path'], None)
+        return fail_count
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        """
+        开始监听，直到调用 stop
+        """
+        comparator = self.create_comparator('refresh')
+        self.watcher = InotifyWatcher(self.options['local_folder'], comparator.ignore_rules)
+        # 先开始监听再全量比较，比较期间的变化不会丢失
+        self.watcher.start()
+        try:
+            records = self.full_refresh()
+            if self.auto_sync and records:
+                self.sync(records)
+            self.log('开始监听本地文件变化...')
+
+            while not self.stopped.is_set():
+                if not self.watcher.wait(0.5):
+                    continue
+                # 等待事件停止一段时间，避免文件正在写入时就开始比较
+                while self.watcher.quiet_for() < self.debounce and not self.stopped.is_set():
+                    time.sleep(min(self.debounce, 0.2))
+                files, dirs, overflowed = self.watcher.take_dirty()
+                if overflowed:
+                    self.log('本地文件变化太多，重新全量比较')
+                    records = self.full_refresh()
+                elif files or dirs:
+                    records = self.refresh_dirty(files, dirs)
+                else:
+                    continue
+                if self.auto_sync and records:
+                    self.sync(records)
+        finally:
+            self.watcher.stop()
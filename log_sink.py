@@ -0,0 +1,64 @@
+"""
+@File  : log_sink.py
+@Author: lyj
+@Create  : 2024/7/30 10:00
+@Modify  :
+@Description  : 后台写日志文件
+
+界面线程只把日志放进队列，后台线程一次取出所有排队的日志，拼接成一条记录写入文件，
+每批只写入、flush 和检查轮转一次，文件超过大小后自动轮转。
+"""
+import logging
+import queue
+import threading
+from logging.handlers import RotatingFileHandler
+
+RESULT_LOG = 'result.log'
+# 单个日志文件的最大字节数和保留的旧文件个数
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+# 后台线程一次最多写入的日志条数
+LOG_BATCH_SIZE = 1000
+
+
+class LogSink:
+    """
+    日志队列和后台写文件线程
+    """
+
+    def __init__(self, path=RESULT_LOG, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT):
+        self.queue = queue.SimpleQueue()
+        self.handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8',
+                                           delay=True)
+        self.handler.setFormatter(logging.Formatter('%(message)s'))
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, message):
+        """
+        日志放进队列，LogRecord 在后台线程中生成
+        """
+        self.queue.put(message)
+
+    def run(self):
+        stopped = False
+        while not stopped:
+            messages = [self.queue.get()]
+            try:
+                while len(messages) < LOG_BATCH_SIZE:
+                    messages.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            if None in messages:
+                stopped = True
+                messages = messages[:messages.index(None)]
+            if messages:
+                self.handler.handle(logging.makeLogRecord({'msg': '\n'.join(messages), 'levelno': logging.INFO}))
+
+    def close(self):
+        """
+        写完队列中剩余的日志后关闭文件
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.handler.close()
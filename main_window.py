@@ -8,13 +8,25 @@
 from datetime import datetime
 
 import yaml
-from PyQt6.QtCore import Qt
-from PyQt6.QtGui import QFont, QColor, QIcon
-from PyQt6.QtWidgets import QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QComboBox, QTextEdit, \
-    QHeaderView, QTableWidget, QTableWidgetItem, QMessageBox, QSplitter
+from PyQt6.QtCore import Qt, QTimer
+from PyQt6.QtGui import QFont, QIcon
+from PyQt6.QtWidgets import QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QComboBox, QPlainTextEdit, \
+    QHeaderView, QTableView, QMessageBox, QSplitter, QCheckBox
 
 from file_compare_thread import FolderComparatorThread
+from file_comparator import comparator_options
 from helper import get_resource
+from log_sink import LogSink
+from multi_server_thread import DEFAULT_CONCURRENCY, MultiServerThread
+from result_table_model import CHANGE_TEXTS, CHANGES, ResultTableModel, change_text, status_text
+from ssh_pool import connection_pool
+
+# 服务器下拉框中同时处理所有服务器的选项
+ALL_SERVERS = "全部服务器"
+# 日志框最多保留的行数，超过后删除最早的行
+LOG_MAX_LINES = 5000
+# 日志攒够这段时间（毫秒）再一次追加到日志框
+LOG_FLUSH_INTERVAL = 100
 
 
 class MainWindow(QMainWindow):
@@ -25,6 +37,13 @@ class MainWindow(QMainWindow):
         self.setGeometry(100, 100, 800, 600)
         self.worker = None
         self.changed_files = []
+        self.log_sink = LogSink()
+        # 等待追加到日志框的日志
+        self.pending_logs = []
+        self.log_timer = QTimer(self)
+        self.log_timer.setSingleShot(True)
+        self.log_timer.setInterval(LOG_FLUSH_INTERVAL)
+        self.log_timer.timeout.connect(self.flush_log_output)
 
         self.init_ui()
 
@@ -39,6 +58,10 @@ class MainWindow(QMainWindow):
         self.refresh_button.setFixedSize(100, 40)
         self.sync_button = QPushButton("同步")
         self.sync_button.setFixedSize(100, 40)
+        # 取消正在进行的刷新
+        self.cancel_button = QPushButton("取消")
+        self.cancel_button.setFixedSize(100, 40)
+        self.cancel_button.setEnabled(False)
         self.server_combo = QComboBox()
         self.server_combo.setFixedSize(300, 40)
 
@@ -47,25 +70,43 @@ class MainWindow(QMainWindow):
         font.setPointSize(11)
         self.server_combo.setFont(font)
 
+        # 刷新时忽略本地哈希缓存，重新计算所有文件
+        self.rehash_checkbox = QCheckBox("重新计算哈希")
+
+        # 按不一致类型过滤表格
+        self.filter_combo = QComboBox()
+        self.filter_combo.setFixedSize(120, 40)
+        self.filter_combo.addItem("全部类型", None)
+        for change, text in zip(CHANGES, CHANGE_TEXTS):
+            self.filter_combo.addItem(text, change)
+
         button_layout.addWidget(self.server_combo)
         button_layout.addWidget(self.refresh_button)
         button_layout.addWidget(self.sync_button)
+        button_layout.addWidget(self.cancel_button)
+        button_layout.addWidget(self.rehash_checkbox)
         button_layout.addStretch(1)
+        button_layout.addWidget(self.filter_combo)
         layout.addLayout(button_layout)
 
         # 使用QSplitter将table和log_output分隔开
         splitter = QSplitter(Qt.Orientation.Vertical)
 
         # 第二层：表格
-        self.table = QTableWidget()
-        self.table.setColumnCount(3)
-        self.table.setHorizontalHeaderLabels(["文件名", "不一致类型", "状态"])
+        self.table_model = ResultTableModel(self)
+        self.table = QTableView()
+        self.table.setModel(self.table_model)
+        self.table.horizontalHeader().setSortIndicator(-1, Qt.SortOrder.AscendingOrder)
+        self.table.setSortingEnabled(True)
         self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
+        # 行高固定，大量数据时不需要逐行计算行高
+        self.table.verticalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Fixed)
         splitter.addWidget(self.table)
 
         # 第三层：多行输入框
-        self.log_output = QTextEdit()
+        self.log_output = QPlainTextEdit()
         self.log_output.setReadOnly(True)
+        self.log_output.setMaximumBlockCount(LOG_MAX_LINES)
         splitter.addWidget(self.log_output)
 
         # 设置初始大小比例
@@ -77,6 +118,9 @@ class MainWindow(QMainWindow):
         # 连接信号和槽
         self.refresh_button.clicked.connect(self.on_refresh)
         self.sync_button.clicked.connect(self.on_sync)
+        self.cancel_button.clicked.connect(self.on_cancel)
+        self.filter_combo.currentIndexChanged.connect(
+            lambda: self.table_model.set_change_filter(self.filter_combo.currentData()))
 
         self.load_servers()
 
@@ -84,6 +128,7 @@ class MainWindow(QMainWindow):
         self.sync_button.setEnabled(flag)
         self.refresh_button.setEnabled(flag)
         self.server_combo.setEnabled(flag)
+        self.rehash_checkbox.setEnabled(flag)
         if flag:
             self.refresh_button.setStyleSheet("")
             self.sync_button.setStyleSheet("")
@@ -99,54 +144,54 @@ class MainWindow(QMainWindow):
                 self.config = yaml.safe_load(file)
                 for server in self.config["servers"]:
                     self.server_combo.addItem(server["name"])
+                if len(self.config["servers"]) > 1:
+                    self.server_combo.addItem(ALL_SERVERS)
         except FileNotFoundError:
             self.config = {"servers": []}
 
     def create_worker(self, server_name, flag, changed_files=None):
         try:
-            current_server = next(server for server in self.config["servers"] if server["name"] == server_name)
-            hostname = current_server.get("hostname")
-            port = current_server.get("port")
-            username = current_server.get("username")
-            key_file_path = current_server.get("key_file_path")
-            password = current_server.get("password")
-            local_folder = current_server.get("local_folder")
-            remote_folder = current_server.get("remote_folder")
-            ignore_folders = current_server.get("ignore_folders")
-            ignore_file_types = current_server.get("ignore_file_types")
-
-            self.worker = FolderComparatorThread(
-                server_name=server_name,
-                flag=flag,
-                ignore_folders=ignore_folders,
-                ignore_file_types=ignore_file_types,
-                changed_files=changed_files,
-                hostname=hostname,
-                port=port,
-                username=username,
-                password=password,
-                key_file_path=key_file_path,
-                local_folder=local_folder,
-                remote_folder=remote_folder
-            )
+            if server_name == ALL_SERVERS:
+                self.worker = MultiServerThread(
+                    servers=self.config["servers"],
+                    flag=flag,
+                    changed_files=changed_files,
+                    force_rehash=self.rehash_checkbox.isChecked(),
+                    concurrency=self.config.get("fanout_concurrency", DEFAULT_CONCURRENCY)
+                )
+            else:
+                current_server = next(server for server in self.config["servers"] if server["name"] == server_name)
+                self.worker = FolderComparatorThread(
+                    server_name=server_name,
+                    flag=flag,
+                    changed_files=changed_files,
+                    force_rehash=self.rehash_checkbox.isChecked(),
+                    **comparator_options(current_server)
+                )
             self.worker.log_signal.connect(self.worker_log_slot)
             self.worker.stop_signal.connect(self.worker_stop_slot)
             self.worker.data_signal.connect(self.worker_data_slot)
 
             self.worker.start()
         except StopIteration:
-            self.log_output.append("选择的服务器未找到，请先设置连接信息。")
+            self.log_output.appendPlainText("选择的服务器未找到，请先设置连接信息。")
         except FileNotFoundError:
-            self.log_output.append("配置文件未找到，请先设置连接信息。")
+            self.log_output.appendPlainText("配置文件未找到，请先设置连接信息。")
 
     def add_log_message(self, message):
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         msg = f"[{timestamp}] {message}"
 
-        with open('result.log', 'a', encoding='utf-8') as f:
-            f.write(f'{msg}\n')
+        # 文件由后台线程批量写入，日志框定时批量追加
+        self.log_sink.write(msg)
+        self.pending_logs.append(msg)
+        if not self.log_timer.isActive():
+            self.log_timer.start()
 
-        self.log_output.append(msg)
+    def flush_log_output(self):
+        logs, self.pending_logs = self.pending_logs[-LOG_MAX_LINES:], []
+        if logs:
+            self.log_output.appendPlainText('\n'.join(logs))
 
     def on_refresh(self):
         reply = QMessageBox.question(self, '确认', '你确定要刷新吗？',
@@ -160,24 +205,17 @@ class MainWindow(QMainWindow):
         self.set_buttons_enabled(False)
         self.clear_table()
         self.create_worker(self.server_combo.currentText(), 'refresh', None)
+        self.cancel_button.setEnabled(bool(self.worker and self.worker.isRunning()))
 
     def on_sync(self):
-        row_count = self.table.rowCount()
-        if not row_count:
+        server_name = self.server_combo.currentText()
+        changed_files = [file for file in self.changed_files
+                         if server_name == ALL_SERVERS or file.get('server') == server_name]
+        if not changed_files:
             QMessageBox.information(self, '提示', '请先刷新/没有需要同步的文件')
             return
 
-        all_sync = True
-        for row in range(self.table.rowCount()):
-            item = self.table.item(row, 2)
-            if item is None:
-                all_sync = False
-                break
-            else:
-                if item.text() == '失败':
-                    all_sync = False
-                    break
-        if all_sync:
+        if self.table_model.all_synced():
             QMessageBox.information(self, '提示', '已经全部同步成功，请勿重复')
             return
 
@@ -189,58 +227,46 @@ class MainWindow(QMainWindow):
 
         self.add_log_message("同步按钮被点击")
         self.set_buttons_enabled(False)
-        self.create_worker(self.server_combo.currentText(), 'sync', self.changed_files)
+        self.create_worker(server_name, 'sync', changed_files)
 
-    def clear_table(self):
-        self.table.clearContents()
-        self.table.setRowCount(0)
-        self.table.setColumnCount(3)
+    def on_cancel(self):
+        if self.worker and self.worker.isRunning():
+            self.add_log_message("取消按钮被点击")
+            self.cancel_button.setEnabled(False)
+            self.worker.cancel()
 
-    def worker_data_slot(self, data):
-        server_name = self.server_combo.currentText()
-        msg = None
-        if data['type'] == 'refresh':
-            if data['change'] == 'not_same':
-                change_item = QTableWidgetItem('不一致')
-                change_item.setBackground(QColor('#FFC7A6'))  # 设置背景颜色
-            elif data['change'] == 'local':
-                change_item = QTableWidgetItem('本地有')
-                change_item.setBackground(QColor('#A3C8FF'))  # 设置背景颜色
-            elif data['change'] == 'remote':
-                change_item = QTableWidgetItem('远程有')
-                change_item.setBackground(QColor('#ACFFA3'))  # 设置背景颜色
-            else:
-                change_item = QTableWidgetItem('Unknown')
-
-            row_number = self.table.rowCount()
-            self.table.insertRow(row_number)
-            self.table.setItem(row_number, 0, QTableWidgetItem(data['path']))
-            self.table.setItem(row_number, 1, change_item)
-
-            self.changed_files.append(data)
-            msg = '{} 刷新，文件: {}, 不一致类型: {}'.format(server_name, data['path'], change_item.text())
-        elif data['type'] == 'sync':
-            for row in range(self.table.rowCount()):
-                item = self.table.item(row, 0)  # 获取第一列的单元格
-                if item is not None:
-                    cell_text = item.text()
-                    if cell_text and cell_text == data['path']:
-                        if data['status']:
-                            status_item = QTableWidgetItem('成功')
-                            status_item.setBackground(QColor('#50FF37'))
-                        else:
-                            status_item = QTableWidgetItem('失败')
-                            status_item.setBackground(QColor('#FF5757'))
-                        self.table.setItem(row, 2, QTableWidgetItem(status_item))
-                        msg = '{} 同步，文件: {}, 状态: {}'.format(server_name, data['path'], status_item.text())
-                        break
-
-        if msg:
+    def clear_table(self):
+        self.table_model.clear()
+
+    def worker_data_slot(self, batch):
+        """
+        后台线程发送的一批结果，一次更新到表格
+        """
+        records = [data for data in batch if data['type'] == 'refresh']
+        results = [data for data in batch if data['type'] == 'sync']
+        if records:
+            self.table_model.add_records(records)
+            self.changed_files.extend(records)
+            for data in records:
+                self.add_log_message('{} 刷新，文件: {}, 不一致类型: {}'.format(
+                    data.get('server'), data['path'], change_text(data['change'])))
+        if results:
+            for data in self.table_model.set_statuses(results):
+                self.add_log_message('{} 同步，文件: {}, 状态: {}'.format(
+                    data.get('server'), data['path'], status_text(data['status'])))
+
+    def worker_log_slot(self, messages):
+        for msg in messages:
             self.add_log_message(msg)
 
-    def worker_log_slot(self, msg):
-        self.add_log_message(msg)
-
     def worker_stop_slot(self):
+        self.cancel_button.setEnabled(False)
         self.set_buttons_enabled(True)
 
+    def closeEvent(self, event):
+        if self.worker and self.worker.isRunning():
+            self.worker.cancel()
+        connection_pool.close_all()
+        self.log_sink.close()
+        super().closeEvent(event)
+
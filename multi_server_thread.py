@@ -0,0 +1,177 @@
+"""
+@File  : multi_server_thread.py
+@Author: lyj
+@Create  : 2024/7/22 10:30
+@Modify  :
+@Description  : 多服务器同时刷新/同步的线程
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from PyQt6.QtCore import QThread, pyqtSignal
+
+from file_comparator import FolderComparator, comparator_options
+from hash_algorithms import AUTO, DEFAULT_ALGORITHM
+from signal_batcher import SignalBatcher
+
+# 同时处理的服务器数量
+DEFAULT_CONCURRENCY = 4
+
+
+def local_scan_key(server, algorithm):
+    """
+    本地扫描结果相同的服务器，key 也相同
+
+    :param algorithm: 服务器实际使用的哈希算法名称，auto 已经探测确定；探测失败时为 None，不共用本地扫描
+    """
+    if algorithm is None:
+        return server["name"]
+    return (server.get("local_folder"), tuple(server.get("ignore_folders") or ()),
+            tuple(server.get("ignore_file_types") or ()), server.get("compare_mode", "hash"), algorithm)
+
+
+class MultiServerThread(QThread):
+    """
+    同时刷新/同步多个服务器。
+
+    使用同一个本地文件夹（且忽略规则相同）的服务器只扫描一次本地文件，
+    各个服务器在线程池中独立执行，一个服务器慢或者失败不影响其他服务器。
+    """
+    # 日志和结果都是一批一批发送的列表，所有服务器共用
+    log_signal = pyqtSignal(list)
+    stop_signal = pyqtSignal()
+    data_signal = pyqtSignal(list)
+
+    def __init__(self, servers, flag, changed_files=None, force_rehash=False, concurrency=DEFAULT_CONCURRENCY):
+        """
+        :param servers: 服务器配置列表
+        :param flag: 操作标志，refresh/sync
+        :param changed_files: 同步时需要处理的文件记录，记录中的 server 字段指明所属服务器
+        :param force_rehash: 是否忽略缓存，重新计算所有本地文件的哈希值
+        :param concurrency: 同时处理的服务器数量
+        """
+        super(MultiServerThread, self).__init__()
+        self.servers = servers
+        self.flag = flag
+        self.changed_files = changed_files or []
+        self.force_rehash = force_rehash
+        self.concurrency = concurrency or DEFAULT_CONCURRENCY
+        self.workers = []
+        # 取消后创建的服务器也立即取消
+        self.cancelled = False
+        self.log_batcher = SignalBatcher(self.log_signal.emit)
+        self.data_batcher = SignalBatcher(self.data_signal.emit)
+
+    def create_comparator(self, server, changed_files=None, local_files=None, algorithm=None):
+        """
+        :param algorithm: 使用的哈希算法名称，默认按服务器配置
+        """
+        options = comparator_options(server)
+        if algorithm:
+            options["hash_algorithm"] = algorithm
+        worker = FolderComparator(
+            server_name=server["name"],
+            flag=self.flag,
+            changed_files=changed_files,
+            force_rehash=self.force_rehash,
+            local_files=local_files,
+            on_log=self.log_batcher.add,
+            on_data=self.data_batcher.add,
+            **options
+        )
+        self.workers.append(worker)
+        if self.cancelled:
+            worker.cancel()
+        return worker
+
+    def cancel(self):
+        """
+        取消所有服务器正在进行的刷新
+        """
+        self.cancelled = True
+        for worker in list(self.workers):
+            worker.cancel()
+
+    def resolve_algorithm(self, server):
+        """
+        确定服务器实际使用的哈希算法，auto 时连接服务器探测一次，连接留在连接池中供刷新复用
+
+        :return: 哈希算法名称，探测失败时为 None
+        """
+        algorithm = server.get("hash_algorithm", DEFAULT_ALGORITHM)
+        if algorithm != AUTO:
+            return algorithm
+        probe = self.create_comparator(server)
+        try:
+            probe.connect()
+            return probe.resolve_hash_algorithm().name
+        except Exception as e:
+            self.log_batcher.add(f'{server["name"]}, 探测哈希算法失败: {e}')
+            return None
+        finally:
+            probe.disconnect()
+
+    def create_refresh_tasks(self, local_executor):
+        """
+        创建每个服务器的刷新任务，共用本地文件夹的服务器共用一次本地扫描。
+        哈希算法为 auto 的服务器先探测出实际的算法，算法相同的才共用。
+        """
+        algorithms = dict(zip((server["name"] for server in self.servers),
+                              local_executor.map(self.resolve_algorithm, self.servers)))
+        groups = {}
+        for server in self.servers:
+            groups.setdefault(local_scan_key(server, algorithms[server["name"]]), []).append(server)
+
+        tasks = {}
+        for servers in groups.values():
+            local_files = None
+            if len(servers) > 1:
+                scanner = self.create_comparator(servers[0], algorithm=algorithms[servers[0]["name"]])
+                local_files = local_executor.submit(scanner.get_all_files, scanner.local_folder)
+            for server in servers:
+                worker = self.create_comparator(server, local_files=local_files, algorithm=algorithms[server["name"]])
+                tasks[server["name"]] = worker.refresh_files
+        return tasks
+
+    def create_sync_tasks(self):
+        """
+        按服务器分组需要同步的文件，创建每个服务器的同步任务
+        """
+        tasks = {}
+        for server in self.servers:
+            files = [file for file in self.changed_files if file.get('server') == server["name"]]
+            if files:
+                tasks[server["name"]] = self.create_comparator(server, changed_files=files).sync_files
+        return tasks
+
+    def run(self):
+        summary = {}
+        self.log_batcher.start()
+        self.data_batcher.start()
+        try:
+            with ThreadPoolExecutor(max_workers=max(len(self.servers), 1)) as local_executor:
+                if self.flag == 'refresh':
+                    tasks = self.create_refresh_tasks(local_executor)
+                else:
+                    tasks = self.create_sync_tasks()
+
+                with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                    futures = {executor.submit(task): name for name, task in tasks.items()}
+                    for future in as_completed(futures):
+                        name = futures[future]
+                        try:
+                            summary[name] = future.result()
+                        except Exception as e:
+                            summary[name] = e
+                            self.log_batcher.add(f'{name}, 处理失败: {e}')
+
+            for name, result in summary.items():
+                if isinstance(result, Exception):
+                    self.log_batcher.add(f'汇总 {name}: 失败')
+                elif self.flag == 'refresh':
+                    self.log_batcher.add(f'汇总 {name}: 共有 {result} 个文件需要处理')
+                else:
+                    self.log_batcher.add(f'汇总 {name}: 同步失败 {result} 个文件')
+        finally:
+            self.data_batcher.close()
+            self.log_batcher.close()
+            self.stop_signal.emit()
@@ -0,0 +1,110 @@
+"""
+@File  : remote_listing.py
+@Author: lyj
+@Create  : 2024/7/10 14:20
+@Modify  :
+@Description  : 拼接获取远程文件列表的shell命令，解析命令输出
+"""
+import posixpath
+import re
+import shlex
+
+from ignore_rules import IgnoreRules
+from remote_manifest import MANIFEST_NAME
+
+# 并行模式下每个校验进程一次处理的文件数
+CHECKSUM_BATCH_SIZE = 256
+
+# 上传大文件时的临时文件后缀，上传完成后改名为目标文件
+UPLOAD_TEMP_SUFFIX = '.filesync-part'
+
+# 输出 "<大小> <修改时间> <路径>"，以 NUL 分隔
+STAT_ACTION = "-printf '%s %T@ %p\\0'"
+
+_ESCAPES = {'n': '\n', 'r': '\r', '\\': '\\'}
+_ESCAPE_PATTERN = re.compile(r'\\(.)')
+
+
+def build_find_command(remote_folder, ignore_folders=None, ignore_file_types=None, action='-print0'):
+    """
+    拼接查找远程文件的 find 命令，被忽略的文件夹整个跳过不进入，排除指定文件类型，
+    默认文件名以 NUL 分隔输出。
+
+    :param remote_folder: 远程文件夹的路径。
+    :param ignore_folders: 需要忽略的文件夹，规则见 ignore_rules
+    :param ignore_file_types: 需要忽略的文件类型后缀
+    :param action: find 的输出动作，如 -print0 或 STAT_ACTION
+    :return: find 命令
+    """
+    rules = IgnoreRules(ignore_folders, ignore_file_types)
+    command = f'find {shlex.quote(remote_folder)} {rules.find_expression(remote_folder)}'
+    # 远程清单文件和上传中的临时文件不参与比较
+    command += f' ! -path {shlex.quote(f"{remote_folder}/{MANIFEST_NAME}*")}'
+    command += f' ! -name {shlex.quote(f"*{UPLOAD_TEMP_SUFFIX}")}'
+    return f'{command} {action}'
+
+
+def build_checksum_command(find_command, jobs=1, hash_command='md5sum'):
+    """
+    在 find 命令后拼接批量计算校验值的命令。
+
+    jobs 为 1 时所有文件交给同一个校验进程，大于 1 时通过 xargs 分批并行计算，
+    stdbuf -oL 让每个进程按行输出，多个进程的输出不会交错在同一行里。
+
+    :param find_command: 以 NUL 分隔输出文件名的 find 命令
+    :param jobs: 并行的校验进程数
+    :param hash_command: 校验命令，md5sum 等
+    :return: 完整的shell命令
+    """
+    if jobs and jobs > 1:
+        return (f'{find_command} | xargs -0 -r -P {int(jobs)} -n {CHECKSUM_BATCH_SIZE} '
+                f'stdbuf -oL {hash_command} --')
+    return f'{find_command} | xargs -0 -r {hash_command} --'
+
+
+def upload_temp_path(remote_file):
+    """
+    上传时使用的临时文件路径，和目标文件在同一个目录下，改名时是原子操作
+
+    :param remote_file: 目标文件的路径
+    """
+    directory, name = posixpath.split(remote_file)
+    return posixpath.join(directory, f'.{name}{UPLOAD_TEMP_SUFFIX}')
+
+
+def parse_checksum_line(line):
+    """
+    解析 md5sum 一类命令输出的一行。
+
+    格式为 "<校验值>  <文件名>"，文件名可以包含空格；文件名中有换行或反斜杠时，
+    行首多一个反斜杠，文件名中的这些字符被转义。
+
+    :param line: 一行输出，不含行尾换行符
+    :return: (校验值, 文件路径)，无法解析时返回 None
+    """
+    escaped = line.startswith('\\')
+    if escaped:
+        line = line[1:]
+    digest, _, name = line.partition(' ')
+    if not digest or len(name) < 2 or name[0] not in ' *':
+        return None
+    name = name[1:]
+    if escaped:
+        name = _ESCAPE_PATTERN.sub(lambda m: _ESCAPES.get(m.group(1), m.group(0)), name)
+    return digest, name
+
+
+def parse_stat_record(record):
+    """
+    解析 STAT_ACTION 输出的一条记录
+
+    :param record: 一条记录，不含结尾的 NUL
+    :return: (大小, 修改时间, 文件路径)，无法解析时返回 None
+    """
+    parts = record.split(' ', 2)
+    if len(parts) != 3:
+        return None
+    try:
+        return int(parts[0]), float(parts[1]), parts[2]
+    except ValueError:
+        return None
@@ -0,0 +1,117 @@
+"""
+@File  : remote_manifest.py
+@Author: lyj
+@Create  : 2024/7/19 14:10
+@Modify  :
+@Description  : 远程文件夹中的清单文件，记录每个文件的大小、修改时间、inode和哈希值，以及使用的哈希算法
+
+获取远程文件列表时，文件的大小、修改时间和inode都和清单一致就直接使用清单中的哈希值，
+只有新增或变化的文件才重新计算，远程获取文件列表的耗时和变化的文件数量成正比。
+"""
+import shlex
+
+MANIFEST_NAME = '.filesync-manifest'
+
+# 输出 "<大小> <修改时间> <inode> <路径>"，以 NUL 分隔
+MANIFEST_STAT_ACTION = "-printf '%s %T@ %i %p\\0'"
+
+# 远程辅助脚本
+#   list:   标准输入为 MANIFEST_STAT_ACTION 的输出，按 md5sum 的格式输出每个文件的哈希值，并重写清单
+#   清单中的算法和本次使用的算法不一致时，所有文件重新计算
+#   update: 标准输入为以 NUL 分隔的相对路径，重新计算这些文件的哈希值，不存在的文件从清单中删除
+MANIFEST_SCRIPT = r'''
+import hashlib, json, os, sys
+root, name, mode, algorithm = sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4]
+manifest_path = os.path.join(root, name)
+try:
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != 1 or manifest.get('algorithm') != algorithm:
+        raise ValueError('unsupported manifest')
+    files = manifest['files']
+except Exception:
+    files = {}
+
+def records():
+    rest = b''
+    for chunk in iter(lambda: sys.stdin.buffer.read(65536), b''):
+        parts = (rest + chunk).split(b'\0')
+        rest = parts.pop()
+        for part in parts:
+            yield os.fsdecode(part)
+    if rest:
+        yield os.fsdecode(rest)
+
+def digest(path):
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def mtime_ns(token):
+    seconds, _, fraction = token.partition('.')
+    return int(seconds) * 1000000000 + int((fraction[:9] or '0').ljust(9, '0'))
+
+changed = False
+if mode == 'list':
+    out = sys.stdout
+    current = {}
+    prefix = root.rstrip('/') + '/'
+    for record in records():
+        size, mtime, inode, path = record.split(' ', 3)
+        relative_path = path[len(prefix):]
+        signature = [int(size), mtime_ns(mtime), int(inode)]
+        entry = files.get(relative_path)
+        if entry and entry[:3] == signature:
+            value = entry[3]
+        else:
+            try:
+                value = digest(path)
+            except OSError as e:
+                sys.stderr.write('%s: %s\n' % (path, e))
+                continue
+            changed = True
+        current[relative_path] = signature + [value]
+        if '\\' in path or '\n' in path:
+            out.write('\\%s  %s\n' % (value, path.replace('\\', '\\\\').replace('\n', '\\n')))
+        else:
+            out.write('%s  %s\n' % (value, path))
+    changed = changed or len(current) != len(files)
+    files = current
+elif mode == 'update':
+    for relative_path in records():
+        path = os.path.join(root, relative_path)
+        try:
+            st = os.stat(path)
+            files[relative_path] = [st.st_size, st.st_mtime_ns, st.st_ino, digest(path)]
+        except OSError:
+            files.pop(relative_path, None)
+        changed = True
+
+if changed:
+    tmp = manifest_path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'version': 1, 'algorithm': algorithm, 'files': files}, f)
+    os.rename(tmp, manifest_path)
+'''
+
+
+def list_command(find_command, remote_root, algorithm='md5'):
+    """
+    通过清单获取远程文件哈希值的命令，输出格式和 md5sum 一致
+
+    :param find_command: 使用 MANIFEST_STAT_ACTION 输出的 find 命令
+    :param remote_root: 远程文件夹的路径
+    :param algorithm: hashlib 支持的哈希算法名称
+    """
+    return (f'{find_command} | python3 -c {shlex.quote(MANIFEST_SCRIPT)} '
+            f'{shlex.quote(remote_root)} {MANIFEST_NAME} list {shlex.quote(algorithm)}')
+
+
+def update_command(remote_root, algorithm='md5'):
+    """
+    同步后更新清单的命令，标准输入为以 NUL 分隔的相对路径
+    """
+    return (f'python3 -c {shlex.quote(MANIFEST_SCRIPT)} {shlex.quote(remote_root)} {MANIFEST_NAME} update '
+            f'{shlex.quote(algorithm)}')
@@ -0,0 +1,241 @@
+"""
+@File  : result_table_model.py
+@Author: lyj
+@Create  : 2024/7/26 10:20
+@Modify  :
+@Description  : 刷新/同步结果的表格模型
+
+每列数据保存在紧凑的数组中，(服务器, 文件) 到记录序号建立索引，同步结果按索引直接更新，
+不需要遍历所有行。排序和按不一致类型过滤只调整显示顺序数组，不复制记录。
+"""
+import heapq
+from array import array
+
+from PyQt6.QtCore import QAbstractTableModel, QModelIndex, Qt
+from PyQt6.QtGui import QColor
+
+# 不一致类型，数组中保存的是下标
+CHANGES = ('not_same', 'local', 'remote', 'move', 'copy')
+CHANGE_TEXTS = ('不一致', '本地有', '远程有', '远程移动', '远程复制')
+CHANGE_COLORS = (QColor('#FFC7A6'), QColor('#A3C8FF'), QColor('#ACFFA3'), QColor('#E3B3FF'), QColor('#FFF0A3'))
+UNKNOWN_CHANGE = -1
+
+# 同步状态
+STATUS_NONE = -1
+STATUS_FAILED = 0
+STATUS_SUCCESS = 1
+STATUS_TEXTS = {STATUS_FAILED: '失败', STATUS_SUCCESS: '成功'}
+STATUS_COLORS = {STATUS_FAILED: QColor('#FF5757'), STATUS_SUCCESS: QColor('#50FF37')}
+
+
+def change_text(change):
+    """
+    不一致类型的显示文字
+    """
+    return CHANGE_TEXTS[CHANGES.index(change)] if change in CHANGES else 'Unknown'
+
+
+def status_text(status):
+    """
+    同步结果的显示文字
+    """
+    return STATUS_TEXTS[STATUS_SUCCESS if status else STATUS_FAILED]
+
+
+HEADERS = ("文件名", "不一致类型", "状态", "服务器")
+COLUMN_PATH, COLUMN_CHANGE, COLUMN_STATUS, COLUMN_SERVER = range(4)
+
+
+class ResultTableModel(QAbstractTableModel):
+    """
+    刷新/同步结果表格，rows 为当前显示顺序下每一行对应的记录序号
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.paths = []
+        self.servers = []
+        self.changes = array('b')
+        self.statuses = array('b')
+        # (服务器, 文件相对路径) -> 记录序号
+        self.index_by_key = {}
+        # 远程移动/复制的记录序号 -> 源文件相对路径
+        self.sources = {}
+        # 显示的行 -> 记录序号，记录序号 -> 显示的行（不显示为 -1）
+        self.rows = array('l')
+        self.positions = array('l')
+        self.change_filter = None
+        self.sort_column = None
+        self.sort_order = Qt.SortOrder.AscendingOrder
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(HEADERS)
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if orientation == Qt.Orientation.Horizontal and role == Qt.ItemDataRole.DisplayRole:
+            return HEADERS[section]
+        return None
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        record = self.rows[index.row()]
+        column = index.column()
+        if role == Qt.ItemDataRole.DisplayRole:
+            if column == COLUMN_PATH:
+                source = self.sources.get(record)
+                return f'{self.paths[record]}  ← {source}' if source else self.paths[record]
+            if column == COLUMN_CHANGE:
+                change = self.changes[record]
+                return CHANGE_TEXTS[change] if change != UNKNOWN_CHANGE else 'Unknown'
+            if column == COLUMN_STATUS:
+                return STATUS_TEXTS.get(self.statuses[record])
+            return self.servers[record]
+        if role == Qt.ItemDataRole.BackgroundRole:
+            if column == COLUMN_CHANGE and self.changes[record] != UNKNOWN_CHANGE:
+                return CHANGE_COLORS[self.changes[record]]
+            if column == COLUMN_STATUS:
+                return STATUS_COLORS.get(self.statuses[record])
+        return None
+
+    def clear(self):
+        self.beginResetModel()
+        self.paths.clear()
+        self.servers.clear()
+        self.changes = array('b')
+        self.statuses = array('b')
+        self.index_by_key.clear()
+        self.sources.clear()
+        self.rows = array('l')
+        self.positions = array('l')
+        self.endResetModel()
+
+    def accepts(self, record):
+        return self.change_filter is None or self.changes[record] == self.change_filter
+
+    def add_records(self, records):
+        """
+        批量添加刷新结果，新的行追加在末尾；有排序时再和已有的行归并，移到排序后的位置
+
+        :param records: 刷新结果字典列表
+        """
+        first = len(self.paths)
+        for data in records:
+            record = len(self.paths)
+            server = data.get('server') or ''
+            self.paths.append(data['path'])
+            self.servers.append(server)
+            change = data['change']
+            self.changes.append(CHANGES.index(change) if change in CHANGES else UNKNOWN_CHANGE)
+            self.statuses.append(STATUS_NONE)
+            self.index_by_key[(server, data['path'])] = record
+            if data.get('source_path'):
+                self.sources[record] = data['source_path']
+
+        visible = [record for record in range(first, len(self.paths)) if self.accepts(record)]
+        self.positions.extend([-1] * (len(self.paths) - first))
+        if not visible:
+            return
+        start = len(self.rows)
+        self.beginInsertRows(QModelIndex(), start, start + len(visible) - 1)
+        for offset, record in enumerate(visible):
+            self.positions[record] = start + offset
+        self.rows.extend(visible)
+        self.endInsertRows()
+
+        if self.sort_column is not None:
+            # 已有的行是有序的，新的行排序后归并；排序是稳定的，相同的值按添加顺序排列
+            key = self.sort_key(self.sort_column)
+            reverse = self.sort_order == Qt.SortOrder.DescendingOrder
+            visible.sort(key=key, reverse=reverse)
+            self.apply_order(heapq.merge(self.rows[:start], visible, key=key, reverse=reverse))
+
+    def set_statuses(self, results):
+        """
+        批量更新同步结果
+
+        :param results: 同步结果字典列表
+        :return: 找到对应行的同步结果列表
+        """
+        matched = []
+        changed_rows = []
+        for data in results:
+            record = self.index_by_key.get((data.get('server') or '', data['path']))
+            if record is None:
+                continue
+            self.statuses[record] = STATUS_SUCCESS if data['status'] else STATUS_FAILED
+            matched.append(data)
+            if self.positions[record] >= 0:
+                changed_rows.append(self.positions[record])
+        if changed_rows:
+            self.dataChanged.emit(self.index(min(changed_rows), COLUMN_STATUS),
+                                  self.index(max(changed_rows), COLUMN_STATUS))
+            if self.sort_column == COLUMN_STATUS:
+                self.apply_order(self.ordered_records())
+        return matched
+
+    def all_synced(self):
+        """
+        是否所有记录都已经同步成功
+        """
+        return all(status == STATUS_SUCCESS for status in self.statuses)
+
+    def sort_key(self, column):
+        if column == COLUMN_PATH:
+            return self.paths.__getitem__
+        if column == COLUMN_CHANGE:
+            return self.changes.__getitem__
+        if column == COLUMN_STATUS:
+            return self.statuses.__getitem__
+        return lambda record: (self.servers[record], self.paths[record])
+
+    def ordered_records(self):
+        """
+        按当前过滤条件和排序方式返回需要显示的记录序号
+        """
+        records = [record for record in range(len(self.paths)) if self.accepts(record)]
+        if self.sort_column is not None:
+            records.sort(key=self.sort_key(self.sort_column),
+                         reverse=self.sort_order == Qt.SortOrder.DescendingOrder)
+        return records
+
+    def rebuild_positions(self):
+        self.positions = array('l', [-1]) * len(self.paths)
+        for row, record in enumerate(self.rows):
+            self.positions[record] = row
+
+    def sort(self, column, order=Qt.SortOrder.AscendingOrder):
+        # 列号为 -1 时恢复原始顺序
+        self.sort_column = column if column >= 0 else None
+        self.sort_order = order
+        self.apply_order(self.ordered_records())
+
+    def apply_order(self, records):
+        """
+        按新的顺序排列当前显示的行，选中的行等持久索引跟随记录移动
+
+        :param records: 当前显示的记录序号的新顺序
+        """
+        self.layoutAboutToBeChanged.emit()
+        persistent = self.persistentIndexList()
+        old_records = [self.rows[index.row()] for index in persistent]
+        self.rows = array('l', records)
+        self.rebuild_positions()
+        self.changePersistentIndexList(persistent, [self.index(self.positions[record], index.column())
+                                                    for record, index in zip(old_records, persistent)])
+        self.layoutChanged.emit()
+
+    def set_change_filter(self, change):
+        """
+        只显示某一种不一致类型
+
+        :param change: not_same/local/remote，为 None 时显示全部
+        """
+        self.beginResetModel()
+        self.change_filter = CHANGES.index(change) if change in CHANGES else None
+        self.rows = array('l', self.ordered_records())
+        self.rebuild_positions()
+        self.endResetModel()
@@ -0,0 +1,72 @@
+"""
+@File  : signal_batcher.py
+@Author: lyj
+@Create  : 2024/7/29 09:30
+@Modify  :
+@Description  : 后台线程的日志和结果攒成一批再发送到界面
+
+每个跨线程信号都要经过界面线程的事件队列，逐条发送时开销和文件数量成正比；
+攒够一定数量或者距离上次发送超过一定时间才发送一次，界面一次处理一批。
+"""
+import threading
+
+# 默认每批最多的条数和最长的等待时间（秒）
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_BATCH_INTERVAL = 0.05
+
+
+class SignalBatcher:
+    """
+    把逐条的数据攒成列表，通过 emit 函数（一般是 pyqtSignal(list) 的 emit）批量发送。
+
+    后台定时线程保证数据最多等待 interval 秒，close 时发送剩余的数据。
+    """
+
+    def __init__(self, emit, size=DEFAULT_BATCH_SIZE, interval=DEFAULT_BATCH_INTERVAL):
+        """
+        :param emit: 发送一批数据的函数，参数为列表
+        :param size: 攒够这么多条立即发送
+        :param interval: 最长等待时间（秒）
+        """
+        self.emit = emit
+        self.size = size
+        self.interval = interval
+        self.items = []
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.closed.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.closed.wait(self.interval):
+            self.flush()
+
+    def add(self, item):
+        with self.lock:
+            self.items.append(item)
+            if len(self.items) >= self.size:
+                self._emit_items()
+
+    def flush(self):
+        with self.lock:
+            self._emit_items()
+
+    def _emit_items(self):
+        # 在锁内发送，保证多个线程发送的批次顺序和添加顺序一致
+        if self.items:
+            items, self.items = self.items, []
+            self.emit(items)
+
+    def close(self):
+        """
+        停止定时发送，发送剩余的数据
+        """
+        self.closed.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        self.flush()
@@ -0,0 +1,144 @@
+"""
+@File  : ssh_pool.py
+@Author: lyj
+@Create  : 2024/7/17 09:30
+@Modify  :
+@Description  : SSH连接池，同一个服务器的刷新和同步共用一个SSH连接
+
+paramiko 导入较慢，在第一次连接时才导入，命令行模式启动时不需要加载。
+"""
+import threading
+import time
+
+# 默认的心跳间隔（秒）
+DEFAULT_KEEPALIVE = 30
+
+
+class SSHConnection:
+    """
+    一个服务器的SSH连接，执行命令的通道和SFTP通道都从同一个 transport 打开
+    """
+
+    def __init__(self, hostname, port, username, password=None, key_file_path=None, keepalive=DEFAULT_KEEPALIVE):
+        self.hostname = hostname
+        self.port = port
+        self.username = username
+        self.password = password
+        self.key_file_path = key_file_path
+        self.keepalive = keepalive
+        self.client = None
+
+    @property
+    def transport(self):
+        return self.client.get_transport() if self.client else None
+
+    def is_active(self):
+        transport = self.transport
+        return bool(transport and transport.is_active())
+
+    def connect(self):
+        """
+        建立连接
+
+        :return: 连接耗时（秒）
+        """
+        import paramiko
+
+        start = time.perf_counter()
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        if self.key_file_path:
+            key = paramiko.RSAKey.from_private_key_file(self.key_file_path)
+            client.connect(self.hostname, port=self.port, username=self.username, pkey=key)
+        elif self.password:
+            client.connect(self.hostname, port=self.port, username=self.username, password=self.password)
+        else:
+            raise ValueError("请配置密码/密钥")
+        if self.keepalive:
+            client.get_transport().set_keepalive(self.keepalive)
+        self.client = client
+        return time.perf_counter() - start
+
+    def open_sftp(self):
+        """
+        在连接上打开一个新的SFTP通道
+        """
+        import paramiko
+
+        return paramiko.SFTPClient.from_transport(self.transport)
+
+    def close(self):
+        if self.client:
+            self.client.close()
+            self.client = None
+
+
+class ConnectionPool:
+    """
+    按服务器保存SSH连接，连接断开时在下次获取时自动重连，并统计连接耗时
+    """
+
+    def __init__(self):
+        self.connections = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+        self.stats = {'connects': 0, 'reuses': 0, 'connect_time': 0.0}
+
+    def acquire(self, hostname, port, username, password=None, key_file_path=None, keepalive=DEFAULT_KEEPALIVE,
+                reconnect=False):
+        """
+        获取服务器的SSH连接，没有可用连接时新建
+
+        :param reconnect: 是否丢弃已有连接重新连接
+        :return: (连接, 本次连接耗时)，复用已有连接时耗时为 None
+        """
+        key = (hostname, port, username, password, key_file_path)
+        with self.lock:
+            key_lock = self.locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            connection = self.connections.get(key)
+            if connection and not reconnect and connection.is_active():
+                with self.lock:
+                    self.stats['reuses'] += 1
+                return connection, None
+
+            if connection:
+                connection.close()
+            connection = SSHConnection(hostname, port, username, password, key_file_path, keepalive)
+            try:
+                elapsed = connection.connect()
+            except Exception:
+                self.connections.pop(key, None)
+                connection.close()
+                raise
+            self.connections[key] = connection
+            with self.lock:
+                self.stats['connects'] += 1
+                self.stats['connect_time'] += elapsed
+            return connection, elapsed
+
+    def release(self, connection):
+        """
+        使用完毕，连接保留在池中；已经断开的连接直接丢弃
+        """
+        if connection.is_active():
+            return
+        with self.lock:
+            for key, value in list(self.connections.items()):
+                if value is connection:
+                    del self.connections[key]
+        connection.close()
+
+    def close_all(self):
+        """
+        关闭所有连接，程序退出时调用
+        """
+        with self.lock:
+            connections = list(self.connections.values())
+            self.connections.clear()
+        for connection in connections:
+            connection.close()
+
+
+connection_pool = ConnectionPool()